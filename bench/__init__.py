@@ -0,0 +1,11 @@
+"""Import throughput benchmarks: synthetic workbooks, a local fake Strapi and a harness.
+
+Run from the repository root:
+
+    python -m bench.run --rows 5000 --latency 0.02 --error-rate 0.01
+"""
+import os
+import sys
+
+# The bot is a single script in src/, not an installed package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
@@ -0,0 +1,153 @@
+"""In-memory stand-in for the Strapi catalog-products API with configurable latency and errors.
+
+    python -m bench.fake_strapi --port 1337 --latency 0.02 --error-rate 0.01
+"""
+import argparse
+import asyncio
+import random
+from datetime import datetime, timezone
+
+from aiohttp import web
+
+class FakeStrapi:
+    """Just enough of the Strapi v4 REST API for the bot: list with filters and pagination, create, update, media upload."""
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.products = {}
+        self.next_id = 1
+        # media ID -> uploaded file name
+        self.media = {}
+        self.requests = 0
+
+    async def _simulate(self):
+        """Wait like a real server would and maybe fail. Returns an error response or None."""
+        self.requests += 1
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        if self.error_rate and self.random.random() < self.error_rate:
+            return web.json_response({'error': {'status': 503, 'message': 'Service Unavailable'}}, status=503)
+        return None
+
+    def add(self, attributes):
+        product_id = self.next_id
+        self.next_id += 1
+        now = datetime.now(timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+        attributes.setdefault('createdAt', now)
+        attributes['updatedAt'] = now
+        self.products[product_id] = attributes
+        return product_id
+
+    async def list_products(self, request):
+        error = await self._simulate()
+        if error:
+            return error
+        query = request.query
+        items = self.products.items()
+        for field in ('articleNumber', 'slug'):
+            values_in = query.getall(f'filters[{field}][$in][]', [])
+            if values_in:
+                wanted = set(values_in)
+                items = [(i, a) for i, a in items if a.get(field) in wanted]
+        if 'filters[articleNumber][$eq]' in query:
+            items = [(i, a) for i, a in items if a.get('articleNumber') == query['filters[articleNumber][$eq]']]
+        if 'filters[updatedAt][$gte]' in query:
+            items = [(i, a) for i, a in items if a['updatedAt'] >= query['filters[updatedAt][$gte]']]
+        items = list(items)
+        page = int(query.get('pagination[page]', 1))
+        page_size = int(query.get('pagination[pageSize]', 25))
+        page_items = items[(page - 1) * page_size:page * page_size]
+        populate = {value for key, value in query.items() if key.startswith('populate[')}
+        return web.json_response({
+            'data': [{'id': i, 'attributes': self.populated(a, populate)} for i, a in page_items],
+            'meta': {'pagination': {
+                'page': page,
+                'pageSize': page_size,
+                'pageCount': max(1, -(-len(items) // page_size)),
+                'total': len(items)
+            }}
+        })
+
+    def populated(self, attributes, populate):
+        """Relations and media in the {"data": ...} shape Strapi returns for populated fields."""
+        attributes = dict(attributes)
+        for field in populate:
+            value = attributes.get(field)
+            if field == 'images':
+                attributes[field] = {'data': [
+                    {'id': media_id, 'attributes': {'url': f'/uploads/{self.media.get(media_id)}'}}
+                    for media_id in value or []
+                ] or None}
+            elif isinstance(value, dict) and 'id' in value:
+                attributes[field] = {'data': {'id': value['id'], 'attributes': {}}}
+        return attributes
+
+    async def create_product(self, request):
+        error = await self._simulate()
+        if error:
+            return error
+        attributes = dict((await request.json())['data'])
+        missing = [media_id for media_id in attributes.get('images') or [] if media_id not in self.media]
+        if missing:
+            return web.json_response({'error': {
+                'status': 400, 'name': 'ValidationError',
+                'message': f"{len(missing)} relation(s) of type plugin::upload.file associated with this entity do not exist",
+                'details': {}
+            }}, status=400)
+        product_id = self.add(attributes)
+        return web.json_response({'data': {'id': product_id, 'attributes': attributes}})
+
+    async def update_product(self, request):
+        error = await self._simulate()
+        if error:
+            return error
+        product_id = int(request.match_info['id'])
+        if product_id not in self.products:
+            return web.json_response({'error': {'status': 404, 'message': 'Not Found'}}, status=404)
+        self.products[product_id].update((await request.json())['data'])
+        return web.json_response({'data': {'id': product_id, 'attributes': self.products[product_id]}})
+
+    async def upload(self, request):
+        error = await self._simulate()
+        if error:
+            return error
+        uploaded = []
+        reader = await request.multipart()
+        async for part in reader:
+            await part.read()
+            media_id = len(self.media) + 1
+            self.media[media_id] = part.filename
+            uploaded.append({'id': media_id, 'name': part.filename})
+        return web.json_response(uploaded)
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_get('/api/catalog-products', self.list_products)
+        app.router.add_post('/api/catalog-products', self.create_product)
+        app.router.add_put('/api/catalog-products/{id}', self.update_product)
+        app.router.add_post('/api/upload', self.upload)
+        return app
+
+def serve(port, latency=0.0, jitter=0.0, error_rate=0.0, existing=0):
+    """Run a fake Strapi until the process is stopped, pre-filled with `existing` benchmark products."""
+    fake = FakeStrapi(latency, jitter, error_rate)
+    for number in range(existing):
+        fake.add({'articleNumber': f"BENCH-{number:07d}", 'slug': f"existing-{number}"})
+    web.run_app(fake.make_app(), host='127.0.0.1', port=port, print=None, access_log=None)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=1337)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument('--jitter', type=float, default=0.0, help="random extra seconds, up to this value")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of requests answered with 503")
+    parser.add_argument('--existing', type=int, default=0, help="benchmark products already in the catalog")
+    args = parser.parse_args()
+    serve(args.port, args.latency, args.jitter, args.error_rate, args.existing)
+
+if __name__ == '__main__':
+    main()
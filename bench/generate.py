@@ -0,0 +1,73 @@
+"""Synthetic product workbooks in the bot's template layout.
+
+    python -m bench.generate 10000 products.xlsx
+"""
+import argparse
+import io
+import random
+
+import openpyxl
+
+import tovary
+
+# Spec strings repeat across variants in real catalogs, so they are drawn from a small pool
+SPECIFICATIONS = [
+    "Диаметр:280мм, Толщина:22мм",
+    "Диаметр:300мм, Толщина:24мм",
+    "Длина:450мм, Материал:Резина",
+    "Объём:1л, Вязкость:5W-30",
+    "Напряжение:12В, Мощность:55Вт"
+]
+DETAILED_SPECIFICATIONS = [
+    spec + extra
+    for spec in SPECIFICATIONS
+    for extra in (", Тип:Вентилируемый", ", Покрытие:С покрытием", ", Страна:Германия")
+]
+NAMES = ["Тормозной диск", "Щётка стеклоочистителя", "Моторное масло", "Лампа фары", "Фильтр салона"]
+
+def generate_rows(rows, seed=0, duplicate_ratio=0.0):
+    """Yield data rows in template column order. duplicate_ratio repeats earlier articles."""
+    rng = random.Random(seed)
+    for row in range(rows):
+        article_number = row
+        if row and rng.random() < duplicate_ratio:
+            article_number = rng.randrange(row)
+        name = rng.choice(NAMES)
+        yield [
+            f"{name} {article_number}",
+            "",
+            f"BENCH-{article_number:07d}",
+            f"Описание товара {name.lower()} номер {article_number}",
+            rng.randint(1, 20),
+            rng.randint(1, 50),
+            rng.randint(1, 30),
+            rng.randint(1, 100),
+            rng.randint(1, 200),
+            rng.choice(SPECIFICATIONS),
+            rng.choice(DETAILED_SPECIFICATIONS),
+            f"https://example.com/product/{article_number}"
+        ]
+
+def generate_workbook(rows, seed=0, duplicate_ratio=0.0):
+    """Return the bytes of an xlsx file with a header row and `rows` product rows."""
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(tovary.TEMPLATE_HEADERS)
+    for row in generate_rows(rows, seed, duplicate_ratio):
+        sheet.append(row)
+    output = io.BytesIO()
+    workbook.save(output)
+    return output.getvalue()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('rows', type=int)
+    parser.add_argument('path')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--duplicate-ratio', type=float, default=0.0)
+    args = parser.parse_args()
+    with open(args.path, 'wb') as f:
+        f.write(generate_workbook(args.rows, args.seed, args.duplicate_ratio))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""Measure import throughput end to end against a local fake Strapi.
+
+Generates a workbook, starts bench.fake_strapi in a separate process, then drives
+extract_products and the bot's upload path directly and reports rows/s,
+per-row latency and peak RSS of the importing process.
+
+    python -m bench.run --rows 5000 --latency 0.02 --error-rate 0.01
+"""
+import argparse
+import asyncio
+import collections
+import logging
+import multiprocessing
+import os
+import resource
+import socket
+import statistics
+import tempfile
+import time
+
+import bench  # noqa: F401  (puts src/ on sys.path)
+import tovary
+from bench.fake_strapi import serve
+from bench.generate import generate_workbook
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.2):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Fake Strapi did not start on port {port}")
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if os.uname().sysname == 'Darwin' else peak / 1024
+
+def reset_peak_rss():
+    """Forget the memory used while setting up, where the kernel allows it (Linux)."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def current_peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return peak_rss_mb()
+
+async def run_import(data, use_index):
+    latencies = []
+    outcomes = collections.Counter()
+    create_product = tovary.create_product_in_strapi
+
+    async def timed_create_product(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await create_product(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - started)
+
+    async def record(product, result):
+        outcomes['success' if result['success'] else result['reason']] += 1
+
+    tovary.create_product_in_strapi = timed_create_product
+    session = tovary.create_strapi_session()
+    try:
+        index = None
+        if use_index:
+            index = tovary.ProductIndex(os.path.join(tempfile.mkdtemp(), 'index.sqlite3'))
+            await index.sync(session)
+        limiter = tovary.AdaptiveLimiter(
+            tovary.UPLOAD_CONCURRENCY, tovary.UPLOAD_MIN_CONCURRENCY,
+            tovary.UPLOAD_MAX_CONCURRENCY, tovary.UPLOAD_TARGET_LATENCY
+        )
+        started = time.perf_counter()
+        results = await tovary.upload_products(
+            session, tovary.extract_products(data, 'xlsx'), index=index, limiter=limiter, on_result=record
+        )
+        elapsed = time.perf_counter() - started
+    finally:
+        tovary.create_product_in_strapi = create_product
+        await session.close()
+    return results, elapsed, latencies, outcomes, limiter
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--duplicate-ratio', type=float, default=0.0, help="share of rows repeating an earlier article")
+    parser.add_argument('--existing', type=int, default=0, help="benchmark products already in the fake catalog")
+    parser.add_argument('--latency', type=float, default=0.01, help="fake Strapi seconds per request")
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of requests answered with 503")
+    parser.add_argument('--no-index', action='store_true', help="check duplicates with bulk $in queries instead of the local index")
+    parser.add_argument('--port', type=int, default=18337)
+    args = parser.parse_args()
+
+    logging.getLogger('tovary').setLevel(logging.ERROR)
+    tovary.STRAPI_API_URL = f'http://127.0.0.1:{args.port}'
+    tovary.STRAPI_RETRY_BASE_DELAY = min(tovary.STRAPI_RETRY_BASE_DELAY, 0.05)
+
+    server = multiprocessing.Process(
+        target=serve,
+        args=(args.port, args.latency, args.jitter, args.error_rate, args.existing),
+        daemon=True
+    )
+    server.start()
+    try:
+        wait_for_port(args.port)
+        # Generated in a child process so openpyxl's write buffers don't count towards peak RSS
+        with multiprocessing.Pool(1) as pool:
+            data = pool.apply(generate_workbook, (args.rows, 0, args.duplicate_ratio))
+
+        reset_peak_rss()
+        results, elapsed, latencies, outcomes, limiter = asyncio.run(run_import(data, not args.no_index))
+    finally:
+        server.terminate()
+        server.join()
+
+    print(f"rows:            {len(results)} ({len(data) / 1024 / 1024:.1f} MB xlsx)")
+    print(f"outcomes:        {dict(outcomes)}")
+    print(f"elapsed:         {elapsed:.2f} s")
+    print(f"throughput:      {len(results) / elapsed:.1f} rows/s")
+    if len(latencies) >= 2:
+        percentiles = statistics.quantiles(latencies, n=100)
+        print(f"latency p50/p99: {percentiles[49] * 1000:.1f} / {percentiles[98] * 1000:.1f} ms per uploaded row")
+    print(f"concurrency:     {int(limiter.limit)} at the end")
+    print(f"peak RSS:        {current_peak_rss_mb():.1f} MB")
+
+if __name__ == '__main__':
+    main()
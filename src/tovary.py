@@ -6,26 +6,207 @@ import aiohttp
 import sys
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import TelegramError
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
-import nest_asyncio
+import logging
+import bisect
+from contextlib import asynccontextmanager, contextmanager, suppress
+from aiohttp import web
 import re
+import sqlite3
+import time
+import json
+import csv
+import hashlib
+import tempfile
+import random
+from email.utils import parsedate_to_datetime
+from urllib.parse import urljoin, urlparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from queue import Empty, Full
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from functools import lru_cache
 
 # Set UTF-8 encoding for stdout
 if sys.stdout.encoding != 'utf-8':
     sys.stdout.reconfigure(encoding='utf-8')
 
-nest_asyncio.apply()
-
 load_dotenv()
 
+logging.basicConfig(
+    format='%(asctime)s %(levelname)s %(name)s: %(message)s',
+    level=os.getenv('LOG_LEVEL', 'INFO').upper()
+)
+# python-telegram-bot and httpx log every request at INFO
+logging.getLogger('httpx').setLevel(logging.WARNING)
+logger = logging.getLogger('tovary')
+
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 STRAPI_API_TOKEN = os.getenv('STRAPI_API_TOKEN')
 STRAPI_API_URL = os.getenv('STRAPI_API_URL')
+# Number of products uploaded to Strapi at the same time when the bot starts.
+# The limit then adapts between the min and max below depending on how Strapi copes.
+UPLOAD_CONCURRENCY = int(os.getenv('UPLOAD_CONCURRENCY', '8'))
+UPLOAD_MIN_CONCURRENCY = int(os.getenv('UPLOAD_MIN_CONCURRENCY', '1'))
+UPLOAD_MAX_CONCURRENCY = int(os.getenv('UPLOAD_MAX_CONCURRENCY', '32'))
+# Seconds per request above which the upload concurrency stops growing
+UPLOAD_TARGET_LATENCY = float(os.getenv('UPLOAD_TARGET_LATENCY', '1.0'))
+# Retries of transient Strapi failures (429/502/503/504, timeouts, dropped connections)
+STRAPI_MAX_RETRIES = int(os.getenv('STRAPI_MAX_RETRIES', '5'))
+STRAPI_RETRY_BASE_DELAY = float(os.getenv('STRAPI_RETRY_BASE_DELAY', '0.5'))
+STRAPI_RETRY_MAX_DELAY = float(os.getenv('STRAPI_RETRY_MAX_DELAY', '30'))
+# Number of article numbers resolved per bulk duplicate query (Strapi caps pageSize at 100 by default)
+DUPLICATE_CHECK_CHUNK_SIZE = int(os.getenv('DUPLICATE_CHECK_CHUNK_SIZE', '100'))
+# Local SQLite index of the articles and slugs already stored in Strapi
+PRODUCT_INDEX_PATH = os.getenv('PRODUCT_INDEX_PATH', 'product_index.sqlite3')
+# Seconds between full index resyncs (delta syncs can't see products deleted in Strapi)
+PRODUCT_INDEX_FULL_SYNC_INTERVAL = int(os.getenv('PRODUCT_INDEX_FULL_SYNC_INTERVAL', str(24 * 60 * 60)))
+# Minimum seconds between edits of the upload progress message
+PROGRESS_UPDATE_INTERVAL = float(os.getenv('PROGRESS_UPDATE_INTERVAL', '3'))
+# Connection pool shared by every request to Strapi
+STRAPI_CONNECTION_LIMIT = int(os.getenv('STRAPI_CONNECTION_LIMIT', '100'))
+STRAPI_CONNECTION_LIMIT_PER_HOST = int(os.getenv('STRAPI_CONNECTION_LIMIT_PER_HOST', '32'))
+STRAPI_KEEPALIVE_TIMEOUT = float(os.getenv('STRAPI_KEEPALIVE_TIMEOUT', '30'))
+STRAPI_DNS_CACHE_TTL = int(os.getenv('STRAPI_DNS_CACHE_TTL', '300'))
+STRAPI_CONNECT_TIMEOUT = float(os.getenv('STRAPI_CONNECT_TIMEOUT', '10'))
+STRAPI_REQUEST_TIMEOUT = float(os.getenv('STRAPI_REQUEST_TIMEOUT', '60'))
+# Worker processes used to parse uploaded files off the event loop
+PARSE_WORKERS = int(os.getenv('PARSE_WORKERS', str(min(4, os.cpu_count() or 1))))
+# Products sent from a parse worker to the bot in one message
+PARSE_CHUNK_SIZE = int(os.getenv('PARSE_CHUNK_SIZE', '200'))
+# Distinct specification strings whose parsed form is cached in each parse worker
+SPEC_CACHE_SIZE = int(os.getenv('SPEC_CACHE_SIZE', '4096'))
+# Uploaded documents are streamed to a per-job spool file in this directory before parsing
+UPLOAD_SPOOL_DIR = os.getenv('UPLOAD_SPOOL_DIR') or tempfile.gettempdir()
+# Largest accepted upload in bytes (the Bot API itself serves files of up to 20 MB)
+MAX_UPLOAD_SIZE = int(os.getenv('MAX_UPLOAD_SIZE', str(20 * 1024 * 1024)))
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Upload jobs running at the same time across all users
+MAX_CONCURRENT_JOBS = int(os.getenv('MAX_CONCURRENT_JOBS', '2'))
+# SQLite journal of per-row outcomes, used to resume interrupted imports
+IMPORT_JOURNAL_PATH = os.getenv('IMPORT_JOURNAL_PATH', 'import_journal.sqlite3')
+# Strapi collections (API plural names) holding the IDs a product row refers to
+RELATION_ENDPOINTS = {
+    'category': os.getenv('STRAPI_CATEGORY_ENDPOINT', 'categories'),
+    'subcategory': os.getenv('STRAPI_SUBCATEGORY_ENDPOINT', 'subcategories'),
+    'brand': os.getenv('STRAPI_BRAND_ENDPOINT', 'brands'),
+    'model': os.getenv('STRAPI_MODEL_ENDPOINT', 'models'),
+    'modification': os.getenv('STRAPI_MODIFICATION_ENDPOINT', 'modifications')
+}
+# Seconds the prefetched relation IDs are trusted before they are fetched again
+RELATION_CACHE_TTL = int(os.getenv('RELATION_CACHE_TTL', '600'))
+# Product images downloaded or uploaded to Strapi at the same time, separate from product uploads
+IMAGE_CONCURRENCY = int(os.getenv('IMAGE_CONCURRENCY', '8'))
+# Largest image accepted from an image URL, in bytes
+IMAGE_MAX_SIZE = int(os.getenv('IMAGE_MAX_SIZE', str(10 * 1024 * 1024)))
+# Media IDs remembered per image URL and per content hash, and for how many seconds
+IMAGE_CACHE_SIZE = int(os.getenv('IMAGE_CACHE_SIZE', '10000'))
+IMAGE_CACHE_TTL = int(os.getenv('IMAGE_CACHE_TTL', '3600'))
+# Drafts published per batch by the publish stage; the requests of a batch go through the shared limiter
+PUBLISH_BATCH_SIZE = int(os.getenv('PUBLISH_BATCH_SIZE', '50'))
+# Publish only the created rows whose relation IDs were all checked against Strapi
+PUBLISH_VALIDATED_ONLY = os.getenv('PUBLISH_VALIDATED_ONLY', '1') == '1'
+# Catalog pages fetched at once by /export
+EXPORT_CONCURRENCY = int(os.getenv('EXPORT_CONCURRENCY', '4'))
+# How updates are received: 'polling', or 'webhook' behind a reverse proxy
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+# Public HTTPS URL the reverse proxy forwards to the webhook server, without the path
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram').strip('/')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '127.0.0.1')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+# Checked against the X-Telegram-Bot-Api-Secret-Token header of every webhook request (optional)
+WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN') or None
+# Telegram user IDs allowed to use admin commands such as /stats (comma separated, empty = everyone)
+ADMIN_USER_IDS = {int(user_id) for user_id in os.getenv('ADMIN_USER_IDS', '').split(',') if user_id.strip()}
+# Local port for a Prometheus-format /metrics endpoint (disabled when empty)
+METRICS_PORT = os.getenv('METRICS_PORT', '')
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+
+class Metrics:
+    """Counters and per-stage latency histograms of the import pipeline."""
+
+    # Upper bounds of the latency histogram buckets, in seconds
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+    def __init__(self):
+        self.counters = {}
+        # stage -> [bucket counts (last one is +Inf), sum, count]
+        self.histograms = {}
+
+    def inc(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, stage, seconds):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = [[0] * (len(self.BUCKETS) + 1), 0.0, 0]
+        histogram[0][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+
+    @contextmanager
+    def timer(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def quantile(self, stage, q):
+        """Estimate a quantile as the upper bound of the bucket it falls in."""
+        buckets, _, count = self.histograms[stage]
+        rank = q * count
+        seen = 0
+        for bound, bucket_count in zip(self.BUCKETS + (float('inf'),), buckets):
+            seen += bucket_count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def render_text(self):
+        lines = ["Счётчики:"]
+        lines += [f"  {name}: {value}" for name, value in sorted(self.counters.items())] or ["  —"]
+        lines.append("Задержки по этапам (кол-во, среднее, p50, p99):")
+        for stage, (_, total, count) in sorted(self.histograms.items()):
+            lines.append(
+                f"  {stage}: {count}, {total / count * 1000:.0f} мс, "
+                f"≤{self.quantile(stage, 0.5) * 1000:.0f} мс, ≤{self.quantile(stage, 0.99) * 1000:.0f} мс"
+            )
+        if not self.histograms:
+            lines.append("  —")
+        return "\n".join(lines)
+
+    def render_prometheus(self):
+        lines = []
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"# TYPE tovary_{name}_total counter")
+            lines.append(f"tovary_{name}_total {value}")
+        lines.append("# TYPE tovary_stage_seconds histogram")
+        for stage, (buckets, total, count) in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.BUCKETS + ('+Inf',), buckets):
+                cumulative += bucket_count
+                lines.append(f'tovary_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'tovary_stage_seconds_sum{{stage="{stage}"}} {total}')
+            lines.append(f'tovary_stage_seconds_count{{stage="{stage}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = [
         [
             InlineKeyboardButton("📥 Загрузить товары", callback_data='upload_products'),
+            InlineKeyboardButton("🔍 Только проверить", callback_data='validate_products')
+        ],
+        [
+            InlineKeyboardButton("🔄 Загрузить и обновить", callback_data='upsert_products'),
+            InlineKeyboardButton("📢 Загрузить и опубликовать", callback_data='publish_products')
+        ],
+        [
             InlineKeyboardButton("📄 Скачать шаблон", callback_data='download_template')
         ]
     ]
@@ -35,13 +216,35 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=reply_markup
     )
 
+# Button -> (upload mode, first line of the instructions)
+UPLOAD_MODES = {
+    'upload_products': ('upload', "Пожалуйста, отправьте Excel файл с товарами.\n\n"),
+    'validate_products': (
+        'validate',
+        "Пожалуйста, отправьте Excel файл для проверки. Товары не будут загружены, "
+        "вы получите файл с отмеченными ошибками.\n\n"
+    ),
+    'upsert_products': (
+        'upsert',
+        "Пожалуйста, отправьте Excel файл с товарами. Новые товары будут созданы, "
+        "а у существующих (по артикулу) обновлены изменившиеся данные.\n\n"
+    ),
+    'publish_products': (
+        'publish',
+        "Пожалуйста, отправьте Excel файл с товарами. После загрузки созданные товары "
+        "будут опубликованы.\n\n"
+    )
+}
+
 async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    if query.data == 'upload_products':
+    if query.data in UPLOAD_MODES:
+        # The next file this user sends is imported, checked or upserted, depending on the button
+        context.user_data['upload_mode'], intro = UPLOAD_MODES[query.data]
         await query.edit_message_text(
-            text="Пожалуйста, отправьте Excel файл с товарами.\n\n"
+            text=intro +
                  "Excel файл должен содержать следующие столбцы:\n"
                  "A: Название (может быть на русском)\n"
                  "B: Slug (только латинские буквы, цифры и дефисы)\n"
@@ -54,184 +257,1903 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
                  "I: ID модификации\n"
                  "J: Спецификации (краткие)\n"
                  "K: Спецификации (подробные)\n"
-                 "L: Ссылка где купить"
+                 "L: Ссылка где купить\n"
+                 "M: Изображения (необязательно, ссылки через пробел)\n\n"
+                 "Также можно отправить CSV, TSV или JSONL файл с теми же столбцами в том же порядке."
         )
     elif query.data == 'download_template':
         await create_and_send_template(update.callback_query.message)
 
 async def process_excel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    document = update.message.document
+    if document.file_size and document.file_size > MAX_UPLOAD_SIZE:
+        await update.message.reply_text(
+            f"Файл слишком большой: максимум {MAX_UPLOAD_SIZE / (1024 * 1024):.3g} МБ. Разбейте его на несколько файлов."
+        )
+        return
+    mode = context.user_data.pop('upload_mode', 'upload')
+    await submit_upload_job(
+        update, context, document.file_id, document.file_name or 'file', document.mime_type, mode
+    )
+
+async def resume(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    unfinished = get_import_journal().latest_unfinished(update.effective_user.id)
+    if unfinished is None:
+        await update.message.reply_text("Нет незавершённых загрузок.")
+        return
+    file_id, file_name, mode = unfinished
+    await submit_upload_job(update, context, file_id, file_name, mode=mode)
+
+async def submit_upload_job(update, context, file_id, file_name, mime_type=None, mode='upload'):
+    message = update.message
+    scheduler = context.bot_data['job_scheduler']
+
+    async def run(job):
+        if mode == 'validate':
+            await run_validation_job(job, message, file_id, mime_type, context.bot, context.bot_data)
+        else:
+            await run_upload_job(
+                job, message, file_id, mime_type, context.bot, context.bot_data,
+                upsert=(mode == 'upsert'), publish=(mode == 'publish')
+            )
+
+    job = scheduler.submit(update.effective_user.id, file_name, run)
+    if job.status == 'queued':
+        await message.reply_text(
+            f"Задача #{job.id} поставлена в очередь. Позиция: {scheduler.queue_position(job)}\n"
+            f"/status — состояние задач, /cancel {job.id} — отменить"
+        )
+
+async def download_to_spool(bot, session, file_id, job_id):
+    """Stream a Telegram document to a new per-job spool file. Returns (path, sha256 hex digest).
+
+    The caller removes the file. Documents larger than MAX_UPLOAD_SIZE are rejected while
+    downloading, before anything is parsed.
+    """
+    too_large = f"Файл больше {MAX_UPLOAD_SIZE / (1024 * 1024):.3g} МБ"
+    file = await bot.get_file(file_id)
+    if file.file_size and file.file_size > MAX_UPLOAD_SIZE:
+        raise RuntimeError(too_large)
+
+    descriptor, path = tempfile.mkstemp(prefix=f'tovary-job{job_id}-', dir=UPLOAD_SPOOL_DIR)
+    digest = hashlib.sha256()
+    size = 0
     try:
-        file = await context.bot.get_file(update.message.document.file_id)
-        file_bytes = await file.download_as_bytearray()
-        
-        products = extract_data_from_excel(file_bytes)
-        
-        if not products:
-            await update.message.reply_text("В Excel файле не найдено товаров или произошла ошибка при обработке.")
-            return
+        with os.fdopen(descriptor, 'wb') as spool:
+            def write(chunk):
+                digest.update(chunk)
+                spool.write(chunk)
 
-        await update.message.reply_text(f"Найдено {len(products)} товаров. Начинаю загрузку в Strapi...")
-        
-        async with aiohttp.ClientSession() as session:
-            success_count = 0
-            duplicate_count = 0
-            error_count = 0
-            
-            for product in products:
-                result = await create_product_in_strapi(session, product, None)
-                if result['success']:
-                    success_count += 1
-                    await update.message.reply_text(f"✅ Создан: {product['name']}")
-                else:
-                    if result['reason'] == 'duplicate':
-                        duplicate_count += 1
-                        await update.message.reply_text(f"⚠️ Пропущен дубликат: {product['name']}")
+            async def add(chunk):
+                nonlocal size
+                size += len(chunk)
+                if size > MAX_UPLOAD_SIZE:
+                    raise RuntimeError(too_large)
+                await asyncio.to_thread(write, chunk)
+
+            if urlparse(file.file_path).scheme in ('http', 'https'):
+                # No total timeout: a large file on a slow link may take longer than a Strapi request
+                timeout = aiohttp.ClientTimeout(
+                    total=None, sock_connect=STRAPI_CONNECT_TIMEOUT, sock_read=STRAPI_REQUEST_TIMEOUT
+                )
+                async with session.get(file.file_path, timeout=timeout) as response:
+                    if response.status != 200:
+                        # Not raise_for_status: the URL contains the bot token
+                        raise RuntimeError(f"Не удалось скачать файл: HTTP {response.status}")
+                    async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                        await add(chunk)
+            else:
+                # A local Bot API server returns the path of the file on its disk
+                with open(file.file_path, 'rb') as source:
+                    while chunk := await asyncio.to_thread(source.read, DOWNLOAD_CHUNK_SIZE):
+                        await add(chunk)
+    except BaseException:
+        remove_spool_file(path)
+        raise
+    return path, digest.hexdigest()
+
+def remove_spool_file(path):
+    if path is not None:
+        with suppress(OSError):
+            os.remove(path)
+
+@asynccontextmanager
+async def job_replies(job, message):
+    """Tell the user when a job is cancelled or fails. The cancellation is raised again for the scheduler."""
+    try:
+        yield
+    except asyncio.CancelledError:
+        if job.progress is not None:
+            job.progress.cancelled = True
+            await job.progress.refresh(force=True, finished=True)
+        await message.reply_text(f"🛑 Задача #{job.id} отменена")
+        raise
+    except Exception as e:
+        await message.reply_text(f"Произошла ошибка: {str(e)}")
+
+async def prepare_checks(session, relation_cache):
+    """Bring the product index and the relation IDs up to date before rows are checked.
+
+    Returns the index, or None if it couldn't be synced: articles are then checked against
+    Strapi in bulk as rows are parsed.
+    """
+    index = get_product_index()
+    try:
+        with metrics.timer('index_sync'):
+            await index.sync(session)
+    except Exception as e:
+        logger.warning("Error syncing product index: %s", e)
+        index = None
+    await relation_cache.refresh(session)
+    return index
+
+async def run_upload_job(job, message, file_id, mime_type, bot, bot_data, upsert=False, publish=False):
+    spool_path = None
+    try:
+        async with job_replies(job, message):
+            metrics.inc('jobs_started')
+            with metrics.timer('download'):
+                spool_path, file_hash = await download_to_spool(bot, bot_data['http_session'], file_id, job.id)
+
+            journal = get_import_journal()
+            mode = 'upsert' if upsert else 'publish' if publish else 'upload'
+            completed = journal.start(file_hash, job.user_id, file_id, job.file_name, mode)
+            if completed is None:
+                await message.reply_text(f"Задача #{job.id}: этот файл уже загружается.")
+                return
+            try:
+                if completed:
+                    await message.reply_text(
+                        f"Задача #{job.id}: продолжаю прерванную загрузку, "
+                        f"{len(completed)} строк уже обработаны ранее."
+                    )
+
+                progress_message = await message.reply_text(
+                    f"Задача #{job.id}: файл получен. Начинаю загрузку товаров в Strapi..."
+                )
+                parse_stats = {}
+                progress = UploadProgress(progress_message, parse_stats)
+                job.progress = progress
+                relation_cache = bot_data['relation_cache']
+                # Drafts created by this file (rows resumed from the journal included), for the publish stage
+                created_ids = []
+                # Created rows left as drafts because their relation IDs couldn't be checked
+                unchecked_ids = []
+
+                async def report_result(product, result):
+                    if not result.get('resumed'):
+                        journal.record(file_hash, product.row, result)
+                    progress.record(product, result)
+                    if publish and result['success'] and result.get('id') and 'action' not in result:
+                        if PUBLISH_VALIDATED_ONLY and not relation_cache.checked(product):
+                            unchecked_ids.append(result['id'])
+                        else:
+                            created_ids.append(result['id'])
+                    await progress.refresh()
+
+                session = bot_data['http_session']
+                index = await prepare_checks(session, relation_cache)
+                # Products are parsed in a worker process and uploaded while the rest of the file is still being parsed
+                products = parse_in_process_pool(
+                    bot_data['parse_pool'], bot_data['parse_manager'], spool_path,
+                    detect_file_format(job.file_name, mime_type), parse_stats
+                )
+                results = await upload_products(
+                    session, products, index=index, completed=completed,
+                    limiter=bot_data['strapi_limiter'], validate=relation_cache.validate,
+                    on_result=report_result, upsert=upsert, images=bot_data['image_uploader']
+                )
+
+                # Still journaled, so a resumed import publishes every draft it created
+                if publish and created_ids:
+                    progress.publish_total = len(created_ids)
+
+                    async def report_published(published, failed):
+                        progress.published_count += published
+                        progress.publish_failed_count += failed
+                        await progress.refresh()
+
+                    await publish_products(session, created_ids, bot_data['strapi_limiter'], on_batch=report_published)
+            except BaseException:
+                # Keep the rows recorded so far so the import can be resumed
+                journal.stop(file_hash)
+                raise
+            journal.finish(file_hash)
+            metrics.inc('jobs_completed')
+
+            await progress.refresh(force=True, finished=True)
+
+            if not results:
+                await message.reply_text("В файле не найдено товаров или произошла ошибка при обработке.")
+                return
+
+            updated = ''
+            if upsert:
+                updated = (
+                    f"🔄 Обновлено: {progress.updated_count} товаров\n"
+                    f"➖ Без изменений: {progress.unchanged_count} товаров\n"
+                )
+            published = ''
+            if publish:
+                published = f"📢 Опубликовано: {progress.published_count} товаров\n"
+                if progress.publish_failed_count:
+                    published += f"❗ Не удалось опубликовать: {progress.publish_failed_count} товаров\n"
+                if unchecked_ids:
+                    published += f"📝 Оставлено черновиками (связи не проверены): {len(unchecked_ids)} товаров\n"
+            with metrics.timer('telegram_send'):
+                await message.reply_document(
+                    document=progress.build_report(),
+                    filename='upload_report.xlsx',
+                    caption=(
+                        f"Загрузка завершена! Обработано {progress.processed} товаров\n"
+                        f"✅ Успешно создано: {progress.success_count} товаров\n"
+                        f"{updated}"
+                        f"{published}"
+                        f"⚠️ Пропущено дубликатов: {progress.duplicate_count} товаров\n"
+                        f"❌ Ошибок: {progress.error_count} товаров"
+                    )
+                )
+
+    finally:
+        remove_spool_file(spool_path)
+
+async def run_validation_job(job, message, file_id, mime_type, bot, bot_data):
+    """Run every check of an import without writing anything to Strapi and send back an annotated file."""
+    spool_path = None
+    try:
+        async with job_replies(job, message):
+            metrics.inc('validations_started')
+            with metrics.timer('download'):
+                spool_path, _ = await download_to_spool(bot, bot_data['http_session'], file_id, job.id)
+
+            progress_message = await message.reply_text(f"Задача #{job.id}: файл получен. Начинаю проверку...")
+            parse_stats = {}
+            progress = UploadProgress(progress_message, parse_stats, title="Проверка файла", keep_details=False,
+                                      success_label="Готово к загрузке")
+            job.progress = progress
+
+            session = bot_data['http_session']
+            relation_cache = bot_data['relation_cache']
+            index = await prepare_checks(session, relation_cache)
+
+            report = ValidationReport()
+            slugs = SlugResolver(session, index)
+
+            async def check_batch(batch):
+                existing_articles = None
+                if index is None:
+                    existing_articles = await fetch_existing_articles(session, [product.article for product in batch])
+                # Rows repeating an article are skipped like an upload would, before any other check
+                checked = [product for product in batch if product.duplicate_of is None]
+                for product in checked:
+                    relation_errors = relation_cache.validate(product)
+                    if relation_errors:
+                        product.errors = (product.errors or []) + relation_errors
+                # Same slugs as an upload of this file would get
+                await slugs.resolve(checked)
+                for product in batch:
+                    article = product.article
+                    if product.duplicate_of is not None:
+                        result = {'success': False, 'reason': 'duplicate', 'error': f"Артикул уже есть в строке {product.duplicate_of}"}
+                    elif product.errors:
+                        result = {'success': False, 'reason': 'invalid', 'error': '; '.join(product.errors)}
+                    elif (index is not None and article in index) or (existing_articles and article in existing_articles):
+                        result = {'success': False, 'reason': 'duplicate', 'error': "Артикул уже есть в каталоге"}
                     else:
-                        error_count += 1
-                        await update.message.reply_text(f"❌ Ошибка создания: {product['name']}")
-        
-        await update.message.reply_text(
-            f"Загрузка завершена!\n"
-            f"✅ Успешно создано: {success_count} товаров\n"
-            f"⚠️ Пропущено дубликатов: {duplicate_count} товаров\n"
-            f"❌ Ошибок: {error_count} товаров"
+                        result = {'success': True}
+
+                    report.add(product, result)
+                    progress.record(product, result)
+                await progress.refresh()
+
+            products = parse_in_process_pool(
+                bot_data['parse_pool'], bot_data['parse_manager'], spool_path,
+                detect_file_format(job.file_name, mime_type), parse_stats, keep_cells=True
+            )
+            batch = []
+            async for product in products:
+                batch.append(product)
+                if len(batch) >= DUPLICATE_CHECK_CHUNK_SIZE:
+                    await check_batch(batch)
+                    batch = []
+            if batch:
+                await check_batch(batch)
+
+            await progress.refresh(force=True, finished=True)
+
+            if not progress.processed:
+                await message.reply_text("В файле не найдено товаров или произошла ошибка при обработке.")
+                return
+
+            with metrics.timer('telegram_send'):
+                await message.reply_document(
+                    document=report.save(),
+                    filename='validation_report.xlsx',
+                    caption=(
+                        f"Проверка завершена! Проверено {progress.processed} строк\n"
+                        f"✅ Готово к загрузке: {progress.success_count}\n"
+                        f"⚠️ Дубликатов: {progress.duplicate_count}\n"
+                        f"❌ С ошибками: {progress.error_count}"
+                    )
+                )
+
+    finally:
+        remove_spool_file(spool_path)
+
+async def run_export_job(job, message, bot_data):
+    """Write the whole catalog into a workbook in the template layout and send it back.
+
+    Pages are streamed into a write-only workbook that is saved to a spool file, so memory
+    doesn't grow with the catalog. The file can be edited and uploaded again in upsert mode.
+    """
+    spool_path = None
+    try:
+        async with job_replies(job, message):
+            progress_message = await message.reply_text(f"Задача #{job.id}: начинаю экспорт каталога...")
+            stats = {}
+            progress = ExportProgress(progress_message, stats)
+            job.progress = progress
+
+            workbook = openpyxl.Workbook(write_only=True)
+            sheet = workbook.create_sheet('Товары')
+            sheet.append(TEMPLATE_HEADERS)
+            params = [(f'populate[{i}]', field) for i, field in enumerate(
+                list(RELATION_ENDPOINTS) + ['specifications', 'detailedSpecifications', 'images']
+            )] + [('publicationState', 'preview'), ('sort[0]', 'id:asc')]
+            with metrics.timer('export'):
+                async for item in iterate_strapi_pages(
+                    bot_data['http_session'], 'catalog-products', params, EXPORT_CONCURRENCY, stats
+                ):
+                    sheet.append(build_export_row(item))
+                    progress.exported += 1
+                    await progress.refresh()
+
+                descriptor, spool_path = tempfile.mkstemp(
+                    prefix=f'tovary-job{job.id}-', suffix='.xlsx', dir=UPLOAD_SPOOL_DIR
+                )
+                os.close(descriptor)
+                await asyncio.to_thread(workbook.save, spool_path)
+            metrics.inc('rows_exported', progress.exported)
+            await progress.refresh(force=True, finished=True)
+
+            if not progress.exported:
+                await message.reply_text("В каталоге нет товаров.")
+                return
+
+            with metrics.timer('telegram_send'), open(spool_path, 'rb') as document:
+                await message.reply_document(
+                    document=document,
+                    filename=f"catalog_{time.strftime('%Y-%m-%d')}.xlsx",
+                    caption=(
+                        f"Экспорт завершён: {progress.exported} товаров.\n"
+                        "Файл можно отредактировать и загрузить через «🔄 Загрузить и обновить»."
+                    )
+                )
+
+    finally:
+        remove_spool_file(spool_path)
+
+class ValidationReport:
+    """The checked file with a status and error column per row, built in write-only mode so memory stays flat."""
+
+    STATUSES = {
+        'success': '✅ OK',
+        'duplicate': '⚠️ Дубликат',
+        'invalid': '❌ Ошибка'
+    }
+
+    def __init__(self):
+        self.workbook = openpyxl.Workbook(write_only=True)
+        self.sheet = self.workbook.create_sheet('Проверка')
+        self.sheet.append(TEMPLATE_HEADERS + ["Статус", "Ошибки"])
+
+    def add(self, product, result):
+        status = self.STATUSES['success' if result['success'] else result['reason']]
+        cells = product.cells
+        if product.slug_generated and not product.errors:
+            # Show the slug the product will get
+            cells = [cells[0], product.slug] + cells[2:]
+        self.sheet.append(cells + [status, result.get('error', '')])
+
+    def save(self):
+        output = io.BytesIO()
+        self.workbook.save(output)
+        output.seek(0)
+        return output
+
+class UploadJob:
+    """One uploaded file waiting for or going through the import."""
+
+    STATUS_NAMES = {
+        'queued': 'в очереди',
+        'running': 'выполняется',
+        'done': 'завершена',
+        'cancelled': 'отменена',
+        'failed': 'ошибка'
+    }
+
+    def __init__(self, job_id, user_id, file_name, run):
+        self.id = job_id
+        self.user_id = user_id
+        self.file_name = file_name
+        self.run = run
+        self.status = 'queued'
+        self.task = None
+        self.progress = None
+
+    def describe(self):
+        text = f"#{self.id} {self.file_name} — {self.STATUS_NAMES[self.status]}"
+        if self.progress is not None:
+            text += f" ({self.progress.summary()})"
+        return text
+
+class JobScheduler:
+    """Runs upload jobs under a global concurrency budget, sharing it fairly between users.
+
+    When a slot frees up, the next job is taken from the user with the fewest running jobs,
+    so one user's pile of large files can't hold up everyone else.
+    """
+
+    # Finished jobs kept around for /status
+    FINISHED_JOBS_KEPT = 50
+
+    def __init__(self, max_running):
+        self.max_running = max_running
+        self.jobs = {}
+        # user id -> queued jobs, in the order users first queued something
+        self.queues = {}
+        self.running_by_user = {}
+        self.next_id = 1
+
+    @property
+    def running_count(self):
+        return sum(self.running_by_user.values())
+
+    def submit(self, user_id, file_name, run):
+        job = UploadJob(self.next_id, user_id, file_name, run)
+        self.next_id += 1
+        self.jobs[job.id] = job
+        self.queues.setdefault(user_id, deque()).append(job)
+        self._dispatch()
+        return job
+
+    def queue_position(self, job):
+        # Approximate: jobs of other users are interleaved fairly, not strictly in submission order
+        return sum(1 for other in self.jobs.values() if other.status == 'queued' and other.id <= job.id)
+
+    def user_jobs(self, user_id):
+        return [job for job in self.jobs.values() if job.user_id == user_id]
+
+    def cancel(self, job_id, user_id):
+        """Cancel a queued or running job. Returns False if the user has no such active job."""
+        job = self.jobs.get(job_id)
+        if job is None or job.user_id != user_id or job.status not in ('queued', 'running'):
+            return False
+        if job.status == 'queued':
+            self.queues[user_id].remove(job)
+            if not self.queues[user_id]:
+                del self.queues[user_id]
+            job.status = 'cancelled'
+        else:
+            job.task.cancel()
+        return True
+
+    def _dispatch(self):
+        while self.queues and self.running_count < self.max_running:
+            user_id = min(self.queues, key=lambda user: self.running_by_user.get(user, 0))
+            # Rotate the user to the back so users with equal load take turns
+            user_queue = self.queues.pop(user_id)
+            job = user_queue.popleft()
+            if user_queue:
+                self.queues[user_id] = user_queue
+            job.status = 'running'
+            self.running_by_user[user_id] = self.running_by_user.get(user_id, 0) + 1
+            job.task = asyncio.create_task(self._run(job))
+
+    async def _run(self, job):
+        try:
+            await job.run(job)
+            job.status = 'done'
+        except asyncio.CancelledError:
+            job.status = 'cancelled'
+        except Exception as e:
+            logger.error("Error in upload job #%s: %s", job.id, e)
+            job.status = 'failed'
+        finally:
+            self.running_by_user[job.user_id] -= 1
+            if not self.running_by_user[job.user_id]:
+                del self.running_by_user[job.user_id]
+            self._prune()
+            self._dispatch()
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.status not in ('queued', 'running')]
+        for job_id in finished[:-self.FINISHED_JOBS_KEPT]:
+            del self.jobs[job_id]
+
+async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    jobs = context.bot_data['job_scheduler'].user_jobs(update.effective_user.id)
+    if not jobs:
+        await update.message.reply_text("У вас нет задач загрузки.")
+        return
+    await update.message.reply_text("Ваши задачи:\n" + "\n".join(job.describe() for job in jobs))
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if ADMIN_USER_IDS and update.effective_user.id not in ADMIN_USER_IDS:
+        await update.message.reply_text("Команда доступна только администраторам.")
+        return
+    scheduler = context.bot_data['job_scheduler']
+    limiter = context.bot_data['strapi_limiter']
+    await update.message.reply_text(
+        f"Задач выполняется: {scheduler.running_count}, "
+        f"в очереди: {sum(len(queue) for queue in scheduler.queues.values())}\n"
+        f"Запросов к Strapi одновременно: {limiter.in_flight} из {int(limiter.limit)}\n\n"
+        + metrics.render_text()
+    )
+
+async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not context.args or not context.args[0].lstrip('#').isdigit():
+        await update.message.reply_text("Использование: /cancel <номер задачи>")
+        return
+    job_id = int(context.args[0].lstrip('#'))
+    if context.bot_data['job_scheduler'].cancel(job_id, update.effective_user.id):
+        await update.message.reply_text(f"Отменяю задачу #{job_id}...")
+    else:
+        await update.message.reply_text(f"Активная задача #{job_id} не найдена.")
+
+async def export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    message = update.message
+    scheduler = context.bot_data['job_scheduler']
+
+    async def run(job):
+        await run_export_job(job, message, context.bot_data)
+
+    job = scheduler.submit(update.effective_user.id, 'catalog.xlsx', run)
+    if job.status == 'queued':
+        await message.reply_text(
+            f"Задача #{job.id} (экспорт каталога) поставлена в очередь. "
+            f"Позиция: {scheduler.queue_position(job)}\n"
+            f"/status — состояние задач, /cancel {job.id} — отменить"
+        )
+
+class ProgressMessage:
+    """One Telegram message edited with a job's progress, at most every PROGRESS_UPDATE_INTERVAL seconds.
+
+    Subclasses provide render(finished) for the message text and summary() for /status.
+    """
+
+    def __init__(self, message, title):
+        self.message = message
+        self.title = title
+        self.started = time.monotonic()
+        self.last_update = 0
+        self.cancelled = False
+
+    async def refresh(self, force=False, finished=False):
+        now = time.monotonic()
+        if not force and now - self.last_update < PROGRESS_UPDATE_INTERVAL:
+            return
+        # Set before awaiting so concurrent workers don't edit the message at the same time
+        self.last_update = now
+        try:
+            with metrics.timer('telegram_send'):
+                await self.message.edit_text(self.render(finished))
+        except TelegramError as e:
+            # A skipped progress update (e.g. flood control) must not fail the job
+            logger.warning("Error updating progress message: %s", e)
+
+class UploadProgress(ProgressMessage):
+    """Counters of a running upload, shown in one throttled, edited Telegram message."""
+
+    def __init__(self, message, parse_stats, title="Загрузка товаров в Strapi", keep_details=True,
+                 success_label="Создано"):
+        super().__init__(message, title)
+        self.success_label = success_label
+        self.keep_details = keep_details
+        self.parse_stats = parse_stats
+        self.success_count = 0
+        self.updated_count = 0
+        self.unchanged_count = 0
+        self.duplicate_count = 0
+        self.error_count = 0
+        # Set once the publish stage starts
+        self.publish_total = None
+        self.published_count = 0
+        self.publish_failed_count = 0
+        # (row, name, article, status, details) for the final report
+        self.details = []
+
+    @property
+    def processed(self):
+        return (
+            self.success_count + self.updated_count + self.unchanged_count
+            + self.duplicate_count + self.error_count
+        )
+
+    def record(self, product, result):
+        metrics.inc(f"rows_{result.get('action', 'success') if result['success'] else result['reason']}")
+        if result.get('action') == 'updated':
+            self.updated_count += 1
+            status = '🔄 Обновлён'
+        elif result.get('action') == 'unchanged':
+            self.unchanged_count += 1
+            status = '➖ Без изменений'
+        elif result['success']:
+            self.success_count += 1
+            status = '✅ Создан'
+        elif result['reason'] == 'duplicate':
+            self.duplicate_count += 1
+            status = '⚠️ Дубликат'
+        else:
+            self.error_count += 1
+            status = '❌ Ошибка'
+        if not self.keep_details:
+            return
+        details = '' if result['success'] else result.get('error', result['reason'])
+        self.details.append((product.row, product.name, product.article, status, details))
+
+    def summary(self):
+        return (
+            f"обработано {self.processed}: ✅ {self.success_count}, "
+            f"⚠️ {self.duplicate_count}, ❌ {self.error_count}"
+        )
+
+    def render(self, finished=False):
+        elapsed = time.monotonic() - self.started
+        rate = self.processed / elapsed if elapsed > 0 else 0
+        # The sheet dimension is only an estimate: empty and invalid rows are skipped
+        total_rows = self.parse_stats.get('total_rows')
+        if finished:
+            header = f"{self.title}: {'отменено' if self.cancelled else 'завершено'} за {elapsed:.0f} с"
+            eta = ''
+        else:
+            header = f"{self.title}..."
+            if total_rows and rate > 0:
+                eta = f"\nОсталось примерно: {max(total_rows - self.processed, 0) / rate:.0f} с"
+            else:
+                eta = ''
+        total = f" из ~{total_rows}" if total_rows and not finished else ''
+        updated = ''
+        if self.updated_count or self.unchanged_count:
+            updated = f"🔄 Обновлено: {self.updated_count}\n➖ Без изменений: {self.unchanged_count}\n"
+        if self.publish_total is not None:
+            if not finished:
+                header = f"{self.title}: публикация..."
+                eta = ''
+            updated += f"📢 Опубликовано: {self.published_count} из {self.publish_total}\n"
+            if self.publish_failed_count:
+                updated += f"❗ Не опубликовано: {self.publish_failed_count}\n"
+        return (
+            f"{header}\n"
+            f"Обработано: {self.processed}{total}\n"
+            f"✅ {self.success_label}: {self.success_count}\n"
+            f"{updated}"
+            f"⚠️ Дубликатов: {self.duplicate_count}\n"
+            f"❌ Ошибок: {self.error_count}\n"
+            f"Скорость: {rate:.1f} строк/с"
+            f"{eta}"
+        )
+
+    def build_report(self):
+        workbook = openpyxl.Workbook(write_only=True)
+        sheet = workbook.create_sheet('Результаты')
+        sheet.append(["Строка", "Название", "Артикул", "Статус", "Подробности"])
+        for row in sorted(self.details):
+            sheet.append(row)
+        report = io.BytesIO()
+        workbook.save(report)
+        report.seek(0)
+        return report
+
+class ExportProgress(ProgressMessage):
+    """Products written by a running /export; stats['total'] is the catalog size once the first page is in."""
+
+    def __init__(self, message, stats):
+        super().__init__(message, "Экспорт каталога")
+        self.stats = stats
+        self.exported = 0
+
+    def summary(self):
+        return f"выгружено {self.exported}"
+
+    def render(self, finished=False):
+        elapsed = time.monotonic() - self.started
+        total = self.stats.get('total')
+        if finished:
+            header = f"{self.title}: {'отменено' if self.cancelled else 'завершено'} за {elapsed:.0f} с"
+        else:
+            header = f"{self.title}..."
+        return (
+            f"{header}\n"
+            f"Выгружено: {self.exported}{f' из {total}' if total is not None else ''}\n"
+            f"Скорость: {self.exported / elapsed if elapsed > 0 else 0:.1f} строк/с"
         )
-    
-    except Exception as e:
-        await update.message.reply_text(f"Произошла ошибка: {str(e)}")
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
-        'Пожалуйста, отправьте Excel файл с данными о товарах.'
+        'Пожалуйста, отправьте Excel, CSV, TSV или JSONL файл с данными о товарах.'
     )
 
-async def create_product_in_strapi(session, product_data, image_id):
+async def iterate_products(products):
+    """Iterate over a plain or async iterable of products without starving the event loop."""
+    if hasattr(products, '__aiter__'):
+        async for product in products:
+            yield product
+    else:
+        for product in products:
+            yield product
+            # Let the workers start uploading while the rest of the file is parsed
+            await asyncio.sleep(0)
+
+def parse_file_to_queue(source, file_format, queue, stop, keep_cells=False):
+    """Parse an uploaded file inside a worker process, sending products back in chunks through the queue."""
+
+    def put(item):
+        # The bot stops reading when an upload is aborted, so don't block forever on a full queue
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=1)
+                return
+            except Full:
+                continue
+
+    stats = {}
+    chunk = []
+    started = time.perf_counter()
+    try:
+        for product in extract_products(source, file_format, stats, keep_cells):
+            if stats and not chunk:
+                put(('stats', stats))
+                stats = {}
+            chunk.append(product)
+            if len(chunk) >= PARSE_CHUNK_SIZE:
+                put(('products', chunk))
+                chunk = []
+            if stop.is_set():
+                return
+        if chunk:
+            put(('products', chunk))
+    finally:
+        # Time spent in the worker, including waits while the uploads catch up
+        put(('done', time.perf_counter() - started))
+
+async def parse_in_process_pool(pool, manager, source, file_format, stats, keep_cells=False):
+    """Yield products parsed by a worker process in the pool as soon as each chunk is ready.
+
+    source is best given as a path: bytes have to be copied to the worker.
+    """
+    loop = asyncio.get_running_loop()
+    # Bounded so a fast parser can't run far ahead of the uploads
+    queue = manager.Queue(maxsize=4)
+    stop = manager.Event()
+    future = loop.run_in_executor(pool, parse_file_to_queue, source, file_format, queue, stop, keep_cells)
+    try:
+        while True:
+            try:
+                kind, payload = await loop.run_in_executor(None, queue.get, True, 1)
+            except Empty:
+                if future.done():
+                    # The worker died without finishing: raise its error
+                    future.result()
+                    return
+                continue
+            if kind == 'stats':
+                stats.update(payload)
+            elif kind == 'products':
+                for product in payload:
+                    yield product
+            else:
+                metrics.observe('parse', payload)
+                break
+        await future
+    finally:
+        stop.set()
+
+async def upload_products(session, products, index=None, completed=None, limiter=None, validate=None, on_result=None,
+                          upsert=False, images=None):
+    """Upload products as they are parsed with a bounded pool of workers, returning results in row order.
+
+    Rows found in completed (sheet row -> result from an earlier run) are reported without being uploaded.
+    Rows that repeat an article of an earlier row (see mark_repeated_rows) are reported as duplicates
+    without any request.
+    Rows with parse errors, or for which validate returns a list of errors, are reported as invalid
+    without any request.
+    With upsert, rows whose article already exists update that product if their content differs from it.
+    With an ImageUploader as images, the image URLs of new products are uploaded ahead of the workers
+    and attached to them.
+    """
+    results = []
+    queue = asyncio.Queue(maxsize=UPLOAD_CONCURRENCY * 2)
+    known_articles = set()
+    slugs = SlugResolver(session, index)
+    # Image stages of rows that are queued but not uploaded yet
+    image_tasks = set()
+
+    async def report(row_index, product, result):
+        results[row_index] = result
+        if on_result:
+            await on_result(product, result)
+
+    async def enqueue(batch):
+        # Slugs are made unique before any row of the batch is uploaded
+        await slugs.resolve([product for _, product in batch])
+        for row_index, product in batch:
+            if product.errors:
+                await report(row_index, product, {'success': False, 'reason': 'invalid', 'error': '; '.join(product.errors)})
+        batch = [(row_index, product) for row_index, product in batch if not product.errors]
+
+        existing_articles = None
+        records = None
+        if upsert:
+            # The existing records are fetched in bulk, one chunk at a time as rows arrive
+            records = await fetch_existing_records(session, [product.article for _, product in batch])
+            if records is None:
+                for row_index, product in batch:
+                    await report(row_index, product, {
+                        'success': False, 'reason': 'api_error', 'error': "Не удалось получить существующие товары"
+                    })
+                return
+            if index is None:
+                known_articles.update(records)
+                existing_articles = known_articles
+        elif index is None:
+            # Without the index, articles are resolved in bulk one chunk at a time as rows arrive
+            found = await fetch_existing_articles(session, [product.article for _, product in batch])
+            if found is not None:
+                known_articles.update(found)
+                existing_articles = known_articles
+        for row_index, product in batch:
+            image_task = None
+            if images is not None and product.image_urls and not (
+                (records and product.article in records)
+                or (index is not None and product.article in index)
+                or (existing_articles is not None and product.article in existing_articles)
+            ):
+                # Images of new products are fetched while earlier rows are still being uploaded
+                image_task = asyncio.ensure_future(images.get_ids(session, product.image_urls))
+                image_tasks.add(image_task)
+                image_task.add_done_callback(image_tasks.discard)
+            await queue.put((row_index, product, existing_articles, records, image_task))
+
+    async def produce():
+        batch = []
+        async for product in iterate_products(products):
+            if completed and product.row in completed:
+                result = completed[product.row]
+                results.append(result)
+                if on_result:
+                    await on_result(product, result)
+                continue
+            if product.duplicate_of is not None:
+                result = {'success': False, 'reason': 'duplicate', 'error': f"Артикул уже есть в строке {product.duplicate_of}"}
+                results.append(result)
+                if on_result:
+                    await on_result(product, result)
+                continue
+            errors = product.errors or (validate(product) if validate else None)
+            if errors:
+                result = {'success': False, 'reason': 'invalid', 'error': '; '.join(errors)}
+                results.append(result)
+                if on_result:
+                    await on_result(product, result)
+                continue
+            results.append(None)
+            batch.append((len(results) - 1, product))
+            if (index is not None and not upsert) or len(batch) >= DUPLICATE_CHECK_CHUNK_SIZE:
+                await enqueue(batch)
+                batch = []
+        if batch:
+            await enqueue(batch)
+        for _ in workers:
+            await queue.put(None)
+
+    async def worker():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            row_index, product, existing_articles, records, image_task = item
+            record = records.get(product.article) if records else None
+            if record is None:
+                try:
+                    image_ids = await image_task if image_task is not None else None
+                except Exception as e:
+                    result = {'success': False, 'reason': 'image_error', 'error': str(e)}
+                else:
+                    result = await create_product_in_strapi(
+                        session, product, image_ids, existing_articles, index, limiter
+                    )
+                    if result.get('reason') == 'image_error':
+                        # Strapi rejected the media, e.g. because it was deleted: upload the images again next time
+                        images.forget(image_ids)
+            else:
+                result = await update_product_in_strapi(session, record, product, index, limiter)
+            await report(row_index, product, result)
+
+    # With an adaptive limiter the workers only cap the concurrency, the limiter sets it
+    worker_count = UPLOAD_MAX_CONCURRENCY if limiter is not None else UPLOAD_CONCURRENCY
+    workers = [asyncio.create_task(worker()) for _ in range(max(1, worker_count))]
+    producer = asyncio.create_task(produce())
+    try:
+        await asyncio.gather(producer, *workers)
+    finally:
+        # Don't leave tasks running if one of them failed
+        for task in [producer, *workers, *image_tasks]:
+            task.cancel()
+    return results
+
+class ProductIndex:
+    """Local SQLite copy of the article numbers and slugs stored in Strapi."""
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS products (
+                id INTEGER PRIMARY KEY,
+                article TEXT,
+                slug TEXT,
+                updated_at TEXT
+            );
+            CREATE INDEX IF NOT EXISTS products_article ON products (article);
+            CREATE INDEX IF NOT EXISTS products_slug ON products (slug);
+            CREATE TABLE IF NOT EXISTS sync_state (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+            """
+        )
+        self.connection.commit()
+        # Articles that are being created right now, so concurrent rows can't both pass the check
+        self.pending_articles = set()
+        self.sync_lock = asyncio.Lock()
+
+    def __contains__(self, article):
+        return self.connection.execute(
+            'SELECT 1 FROM products WHERE article = ? LIMIT 1', (article,)
+        ).fetchone() is not None
+
+    def has_slug(self, slug):
+        return self.connection.execute(
+            'SELECT 1 FROM products WHERE slug = ? LIMIT 1', (slug,)
+        ).fetchone() is not None
+
+    def slug_owners(self, slugs):
+        """Return slug -> article for the given slugs that are taken."""
+        owners = {}
+        slugs = list(slugs)
+        # Stay below SQLite's limit on bound parameters
+        for start in range(0, len(slugs), 500):
+            chunk = slugs[start:start + 500]
+            owners.update(self.connection.execute(
+                f"SELECT slug, article FROM products WHERE slug IN ({', '.join('?' * len(chunk))})", chunk
+            ).fetchall())
+        return owners
+
+    def reserve(self, article):
+        """Claim an article for creation. Returns False if it already exists or is being created."""
+        if article in self.pending_articles or article in self:
+            return False
+        self.pending_articles.add(article)
+        return True
+
+    def release(self, article):
+        self.pending_articles.discard(article)
+
+    def add(self, product_id, article, slug, updated_at=None):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO products (id, article, slug, updated_at) VALUES (?, ?, ?, ?)',
+            (product_id, article, slug, updated_at)
+        )
+        self.connection.commit()
+        self.pending_articles.discard(article)
+
+    def _get_state(self, key):
+        row = self.connection.execute('SELECT value FROM sync_state WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_state(self, key, value):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)', (key, value)
+        )
+
+    async def sync(self, session):
+        """Bring the index up to date: a full sync the first time, then only products changed since the last sync."""
+        async with self.sync_lock:
+            last_updated_at = self._get_state('last_updated_at')
+            last_full_sync = float(self._get_state('last_full_sync') or 0)
+            full_sync = not last_updated_at or time.time() - last_full_sync > PRODUCT_INDEX_FULL_SYNC_INTERVAL
+
+            headers = {
+                'Authorization': f'Bearer {STRAPI_API_TOKEN}'
+            }
+            params = [
+                ('fields[0]', 'articleNumber'),
+                ('fields[1]', 'slug'),
+                ('fields[2]', 'updatedAt'),
+                ('sort[0]', 'updatedAt:asc'),
+                ('pagination[pageSize]', '100'),
+                # Drafts count as existing products too
+                ('publicationState', 'preview')
+            ]
+            if not full_sync:
+                # $gte so products saved in the same millisecond as the last one seen aren't missed
+                params.append(('filters[updatedAt][$gte]', last_updated_at))
+
+            rows = []
+            newest_updated_at = last_updated_at
+            page = 1
+            while True:
+                status, text = await strapi_request(
+                    session, 'GET', f'{STRAPI_API_URL}/api/catalog-products',
+                    params=params + [('pagination[page]', str(page))],
+                    headers=headers
+                )
+                if status != 200:
+                    raise RuntimeError(f"Strapi returned {status}: {text}")
+                body = json.loads(text)
+
+                for item in body.get('data') or []:
+                    attributes = item['attributes']
+                    rows.append((item['id'], attributes.get('articleNumber'), attributes.get('slug'), attributes.get('updatedAt')))
+                    if attributes.get('updatedAt') and (not newest_updated_at or attributes['updatedAt'] > newest_updated_at):
+                        newest_updated_at = attributes['updatedAt']
+
+                page_count = body.get('meta', {}).get('pagination', {}).get('pageCount', 1)
+                if page >= page_count:
+                    break
+                page += 1
+
+            # Only touch the table once every page has been fetched, so a failed sync leaves the old index intact
+            if full_sync:
+                self.connection.execute('DELETE FROM products')
+                self._set_state('last_full_sync', str(time.time()))
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO products (id, article, slug, updated_at) VALUES (?, ?, ?, ?)', rows
+            )
+            if newest_updated_at:
+                self._set_state('last_updated_at', newest_updated_at)
+            self.connection.commit()
+            logger.info("Product index %s sync: %d products", 'full' if full_sync else 'delta', len(rows))
+
+_product_index = None
+
+def get_product_index():
+    global _product_index
+    if _product_index is None:
+        _product_index = ProductIndex(PRODUCT_INDEX_PATH)
+    return _product_index
+
+async def iterate_strapi_pages(session, collection, params, concurrency=1, stats=None):
+    """Yield the items of every page of a Strapi collection, in page order.
+
+    After the first page, up to `concurrency` following pages are fetched ahead, so at most
+    that many pages are held in memory. The collection total is stored in stats['total'].
+    """
+    headers = {
+        'Authorization': f'Bearer {STRAPI_API_TOKEN}'
+    }
+
+    async def fetch_page(page):
+        status, text = await strapi_request(
+            session, 'GET', f'{STRAPI_API_URL}/api/{collection}',
+            params=params + [('pagination[page]', str(page)), ('pagination[pageSize]', '100')],
+            headers=headers
+        )
+        if status != 200:
+            raise RuntimeError(f"Strapi returned {status} for {collection}: {text}")
+        return json.loads(text)
+
+    body = await fetch_page(1)
+    pagination = body.get('meta', {}).get('pagination', {})
+    page_count = pagination.get('pageCount', 1)
+    if stats is not None:
+        stats['total'] = pagination.get('total')
+    pending = deque()
+    next_page = 2
+    try:
+        while True:
+            while next_page <= page_count and len(pending) < concurrency:
+                pending.append(asyncio.ensure_future(fetch_page(next_page)))
+                next_page += 1
+            for item in body.get('data') or []:
+                yield item
+            if not pending:
+                break
+            body = await pending.popleft()
+    finally:
+        for task in pending:
+            task.cancel()
+
+class RelationCache:
+    """Valid category, subcategory, brand, model and modification IDs, prefetched from Strapi with a TTL."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        # relation -> set of IDs, or None if the list couldn't be fetched
+        self.ids = {}
+        self.fetched_at = 0
+        self.lock = asyncio.Lock()
+
+    async def _fetch_ids(self, session, relation):
+        try:
+            return {
+                item['id'] async for item in iterate_strapi_pages(
+                    session, RELATION_ENDPOINTS[relation],
+                    [('fields[0]', 'id'), ('publicationState', 'preview')]
+                )
+            }
+        except Exception as e:
+            # Rows are still uploaded, Strapi itself will reject unknown IDs
+            logger.warning("Error fetching %s IDs: %s", relation, e)
+            return None
+
+    async def refresh(self, session, force=False):
+        async with self.lock:
+            if not force and time.monotonic() - self.fetched_at < self.ttl:
+                return
+            relations = list(RELATION_ENDPOINTS)
+            id_sets = await asyncio.gather(*(self._fetch_ids(session, relation) for relation in relations))
+            self.ids = dict(zip(relations, id_sets))
+            self.fetched_at = time.monotonic()
+            logger.info("Relation IDs: %s", ", ".join(
+                f"{relation}={'?' if ids is None else len(ids)}" for relation, ids in self.ids.items()
+            ))
+
+    def validate(self, product):
+        """Return a list of errors for relation IDs in the row that don't exist in Strapi."""
+        errors = []
+        for relation in RELATION_ENDPOINTS:
+            column, title = FIELD_COLUMNS[relation]
+            value = getattr(product, relation)
+            ids = self.ids.get(relation)
+            if value and ids is not None and value not in ids:
+                errors.append(f"{column}{product.row}: {title} {value} не найден")
+        return errors
+
+    def checked(self, product):
+        """Whether every relation ID set in the row could be checked, i.e. its list was fetched from Strapi."""
+        return all(
+            self.ids.get(relation) is not None
+            for relation in RELATION_ENDPOINTS if getattr(product, relation)
+        )
+
+class ImportJournal:
+    """SQLite checkpoint journal of per-row outcomes, keyed by the hash of the uploaded file."""
+
+    # Row outcomes that don't need another attempt when an import is resumed;
+    # an upsert records its 'updated' and 'unchanged' actions in place of 'success'
+    FINAL_STATUSES = ('success', 'updated', 'unchanged', 'duplicate')
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                file_hash TEXT PRIMARY KEY,
+                user_id INTEGER,
+                file_id TEXT,
+                file_name TEXT,
+                finished INTEGER DEFAULT 0,
+                updated_at REAL,
+                mode TEXT DEFAULT 'upload'
+            );
+            CREATE TABLE IF NOT EXISTS rows (
+                file_hash TEXT,
+                row INTEGER,
+                status TEXT,
+                details TEXT,
+                PRIMARY KEY (file_hash, row)
+            );
+            """
+        )
+        columns = {column[1] for column in self.connection.execute('PRAGMA table_info(files)')}
+        if 'mode' not in columns:
+            # Journals created before imports were resumed in their own mode
+            self.connection.execute("ALTER TABLE files ADD COLUMN mode TEXT DEFAULT 'upload'")
+        self.connection.commit()
+        # Files being imported right now, so the same file can't run twice at once
+        self.active = set()
+
+    def start(self, file_hash, user_id, file_id, file_name, mode='upload'):
+        """Register an import and return {row: result} for rows finished by an earlier, interrupted run.
+
+        Returns None if the same file is already being imported.
+        """
+        if file_hash in self.active:
+            return None
+        self.active.add(file_hash)
+
+        existing = self.connection.execute(
+            'SELECT finished, mode FROM files WHERE file_hash = ?', (file_hash,)
+        ).fetchone()
+        if existing is None or existing[0]:
+            # A finished file sent again is imported from scratch
+            self.connection.execute('DELETE FROM rows WHERE file_hash = ?', (file_hash,))
+        elif existing[1] != mode:
+            # Sent again in another mode: a row that was a duplicate for a plain upload is an update
+            # for an upsert, so only the outcomes that hold in any mode are kept
+            self.connection.execute(
+                "DELETE FROM rows WHERE file_hash = ? AND status = 'duplicate'", (file_hash,)
+            )
+        self.connection.execute(
+            'INSERT OR REPLACE INTO files (file_hash, user_id, file_id, file_name, finished, updated_at, mode) '
+            'VALUES (?, ?, ?, ?, 0, ?, ?)',
+            (file_hash, user_id, file_id, file_name, time.time(), mode)
+        )
+        self.connection.commit()
+
+        completed = {}
+        placeholders = ', '.join('?' for _ in self.FINAL_STATUSES)
+        for row, status, details in self.connection.execute(
+            f'SELECT row, status, details FROM rows WHERE file_hash = ? AND status IN ({placeholders})',
+            (file_hash, *self.FINAL_STATUSES)
+        ):
+            if status == 'success':
+                completed[row] = {'success': True, 'id': int(details) if details else None, 'resumed': True}
+            elif status != 'duplicate':
+                completed[row] = {
+                    'success': True, 'id': int(details) if details else None, 'action': status, 'resumed': True
+                }
+            else:
+                completed[row] = {'success': False, 'reason': status, 'resumed': True}
+        return completed
+
+    def record(self, file_hash, row, result):
+        if result['success']:
+            status, details = result.get('action', 'success'), result.get('id')
+        else:
+            status, details = result['reason'], result.get('error')
+        self.connection.execute(
+            'INSERT OR REPLACE INTO rows (file_hash, row, status, details) VALUES (?, ?, ?, ?)',
+            (file_hash, row, status, None if details is None else str(details))
+        )
+        # Committed per row, so after a crash no finished row is sent again; cheap with WAL and synchronous=NORMAL
+        self.connection.commit()
+
+    def stop(self, file_hash):
+        """Keep an interrupted import's progress so it can be resumed."""
+        self.connection.execute('UPDATE files SET updated_at = ? WHERE file_hash = ?', (time.time(), file_hash))
+        self.connection.commit()
+        self.active.discard(file_hash)
+
+    def finish(self, file_hash):
+        self.connection.execute('UPDATE files SET finished = 1, updated_at = ? WHERE file_hash = ?', (time.time(), file_hash))
+        self.connection.execute('DELETE FROM rows WHERE file_hash = ?', (file_hash,))
+        self.connection.commit()
+        self.active.discard(file_hash)
+
+    def latest_unfinished(self, user_id):
+        """Return (file_id, file_name, mode) of the user's most recent interrupted import, if any."""
+        for file_hash, file_id, file_name, mode in self.connection.execute(
+            'SELECT file_hash, file_id, file_name, mode FROM files WHERE user_id = ? AND finished = 0 '
+            'ORDER BY updated_at DESC',
+            (user_id,)
+        ):
+            if file_hash not in self.active:
+                return file_id, file_name, mode
+        return None
+
+_import_journal = None
+
+def get_import_journal():
+    global _import_journal
+    if _import_journal is None:
+        _import_journal = ImportJournal(IMPORT_JOURNAL_PATH)
+    return _import_journal
+
+async def fetch_existing_articles(session, articles):
+    """Return the set of article numbers that already exist in Strapi, or None if the check failed."""
+    with metrics.timer('duplicate_check'):
+        items = await _fetch_products_by(session, 'articleNumber', articles, [('fields[0]', 'articleNumber')])
+    return None if items is None else set(items)
+
+async def fetch_existing_records(session, articles):
+    """Return article -> {'id', 'hash'} for the articles that already exist in Strapi, or None if the lookup failed."""
+    params = [(f'populate[{i}]', field) for i, field in enumerate(
+        list(RELATION_ENDPOINTS) + ['specifications', 'detailedSpecifications']
+    )]
+    with metrics.timer('upsert_lookup'):
+        items = await _fetch_products_by(session, 'articleNumber', articles, params)
+    if items is None:
+        return None
+    return {
+        article: {'id': item['id'], 'hash': content_hash(item['attributes'])}
+        for article, item in items.items()
+    }
+
+async def _fetch_products_by(session, field, values, extra_params):
+    """Return value -> Strapi item for the products whose field has one of the values, queried in chunks with $in."""
+    headers = {
+        'Authorization': f'Bearer {STRAPI_API_TOKEN}'
+    }
+    unique_values = list(dict.fromkeys(value for value in values if value))
+    existing_products = {}
+
+    try:
+        for start in range(0, len(unique_values), DUPLICATE_CHECK_CHUNK_SIZE):
+            chunk = unique_values[start:start + DUPLICATE_CHECK_CHUNK_SIZE]
+            page = 1
+            while True:
+                params = [(f'filters[{field}][$in][]', value) for value in chunk]
+                params += extra_params + [
+                    ('publicationState', 'preview'),
+                    ('pagination[page]', str(page)),
+                    ('pagination[pageSize]', str(DUPLICATE_CHECK_CHUNK_SIZE))
+                ]
+                status, text = await strapi_request(
+                    session, 'GET', f'{STRAPI_API_URL}/api/catalog-products',
+                    params=params,
+                    headers=headers
+                )
+                if status != 200:
+                    logger.warning("Error checking for duplicates: %s", text)
+                    return None
+                body = json.loads(text)
+
+                for item in body.get('data') or []:
+                    existing_products[item['attributes'][field]] = item
+
+                page_count = body.get('meta', {}).get('pagination', {}).get('pageCount', 1)
+                if page >= page_count:
+                    break
+                page += 1
+    except Exception as e:
+        logger.warning("Error checking for duplicates: %s", e)
+        return None
+
+    logger.info("Found %d existing products out of %d %s values", len(existing_products), len(unique_values), field)
+    return existing_products
+
+class AdaptiveLimiter:
+    """Limit on requests in flight to Strapi, adjusted with additive increase / multiplicative decrease.
+
+    The limit grows by about one per round of requests while responses are fast, and is halved
+    when Strapi pushes back (429/5xx overload statuses, timeouts), at most once per cooldown.
+    """
+
+    def __init__(self, initial, minimum, maximum, target_latency):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.target_latency = target_latency
+        self.in_flight = 0
+        self.last_decrease = 0
+        self.condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def __aexit__(self, *exc_info):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def on_success(self, latency):
+        if latency <= self.target_latency and self.in_flight + 1 >= int(self.limit):
+            # Only grow while the current limit is actually being used
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def on_overload(self):
+        now = time.monotonic()
+        # Requests in flight during one overload all fail together; count that as a single signal
+        if now - self.last_decrease < self.target_latency:
+            return
+        self.last_decrease = now
+        self.limit = max(self.minimum, self.limit / 2)
+        logger.warning("Strapi is overloaded, upload concurrency lowered to %d", int(self.limit))
+
+def get_retry_delay(attempt, retry_after=None):
+    """Seconds to wait before the next attempt: Retry-After if Strapi sent it, otherwise exponential backoff with full jitter."""
+    if retry_after:
+        try:
+            return min(float(retry_after), STRAPI_RETRY_MAX_DELAY)
+        except ValueError:
+            try:
+                return min(max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0), STRAPI_RETRY_MAX_DELAY)
+            except (TypeError, ValueError):
+                pass
+    return random.uniform(0, min(STRAPI_RETRY_MAX_DELAY, STRAPI_RETRY_BASE_DELAY * 2 ** attempt))
+
+# Statuses that mean Strapi or the proxy in front of it is temporarily unable to serve the request
+RETRY_STATUSES = (429, 502, 503, 504)
+# Of those, the statuses that mean the request was turned away before Strapi acted on it;
+# after a 502 or 504 from the proxy the request may still have been carried out
+UNPROCESSED_STATUSES = (429, 503)
+# Methods that can be sent again after a lost response without doing the work twice
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
+
+async def strapi_request(session, method, url, limiter=None, **kwargs):
+    """Send a request to Strapi, retrying transient failures. Returns (status, response text).
+
+    A POST that timed out, lost its connection or got a 502/504 may already have been carried out,
+    so it is only retried when the connection couldn't be opened or Strapi turned it away (429/503).
+    """
+    attempt = 0
+    while True:
+        retry_after = None
+        started = time.monotonic()
+        try:
+            if limiter is not None:
+                async with limiter:
+                    async with session.request(method, url, **kwargs) as response:
+                        status = response.status
+                        text = await response.text()
+                        retry_after = response.headers.get('Retry-After')
+            else:
+                async with session.request(method, url, **kwargs) as response:
+                    status = response.status
+                    text = await response.text()
+                    retry_after = response.headers.get('Retry-After')
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            if limiter is not None:
+                limiter.on_overload()
+            if attempt >= STRAPI_MAX_RETRIES:
+                raise
+            if method not in IDEMPOTENT_METHODS and not isinstance(e, aiohttp.ClientConnectorError):
+                raise
+            logger.warning("%s %s failed (%r), retrying", method, url, e)
+            metrics.inc('strapi_retries')
+        else:
+            if status not in RETRY_STATUSES:
+                if limiter is not None:
+                    limiter.on_success(time.monotonic() - started)
+                return status, text
+            if limiter is not None:
+                limiter.on_overload()
+            if attempt >= STRAPI_MAX_RETRIES:
+                return status, text
+            if method not in IDEMPOTENT_METHODS and status not in UNPROCESSED_STATUSES:
+                return status, text
+            logger.warning("%s %s returned %s, retrying", method, url, status)
+            metrics.inc('strapi_retries')
+        await asyncio.sleep(get_retry_delay(attempt, retry_after))
+        attempt += 1
+
+def strapi_error_fields(text):
+    """Names of the attributes a Strapi error response blames, e.g. {'images'}."""
+    try:
+        error = json.loads(text).get('error') or {}
+    except (ValueError, AttributeError):
+        return set()
+    fields = {
+        str(item['path'][0]) for item in (error.get('details') or {}).get('errors') or [] if item.get('path')
+    }
+    # "Relation(s) of type plugin::upload.file associated with this entity do not exist"
+    if 'plugin::upload.file' in (error.get('message') or ''):
+        fields.add('images')
+    return fields
+
+def build_product_payload(product_data):
+    """Strapi attributes for a product row, shared by create and update."""
+    # Use the slug from product_data instead of generating it
+    payload = {
+        "name": product_data.name,
+        "slug": product_data.slug,  # Use the slug from product_data
+        "articleNumber": product_data.article,
+        "description": product_data.description,
+        "specifications": [{"label": label, "value": value} for label, value in product_data.specifications],
+        "detailedSpecifications": [
+            {"label": label, "value": value} for label, value in product_data.detailed_specifications
+        ],
+        "whereToBuyLink": product_data.where_to_buy_link
+    }
+
+    # Add relations with proper format for Strapi v4 manyToOne relations
+    for relation in RELATION_ENDPOINTS:
+        if getattr(product_data, relation):
+            payload[relation] = {"id": getattr(product_data, relation)}
+    return payload
+
+def relation_id(value):
+    """Id of a relation given as {"id": 1} in a payload, {"data": {"id": 1, ...}} or {"data": null} when populated."""
+    if isinstance(value, dict) and 'data' in value:
+        value = value['data']
+    return value.get('id') if isinstance(value, dict) else None
+
+def build_export_row(item):
+    """A Strapi product as a row in the template layout, the inverse of build_product."""
+    attributes = item['attributes']
+    images = (attributes.get('images') or {}).get('data') or []
+    return [
+        attributes.get('name'),
+        attributes.get('slug'),
+        attributes.get('articleNumber'),
+        attributes.get('description'),
+        *(relation_id(attributes.get(relation)) for relation in RELATION_ENDPOINTS),
+        format_specifications(attributes.get('specifications')),
+        format_specifications(attributes.get('detailedSpecifications')),
+        attributes.get('whereToBuyLink'),
+        # Media urls are relative to Strapi unless an upload provider serves them elsewhere
+        ' '.join(urljoin(f'{STRAPI_API_URL}/', image['attributes']['url']) for image in images) or None
+    ]
+
+def content_hash(attributes):
+    """Hash of the fields an import sets, normalized so a payload and the stored product compare equal.
+
+    Publication state and images are not compared: an update leaves them as they are in Strapi.
+    """
+    content = {
+        field: attributes.get(field) or ''
+        for field in ('name', 'slug', 'articleNumber', 'description', 'whereToBuyLink')
+    }
+    for field in ('specifications', 'detailedSpecifications'):
+        # Stored components also carry their own ids
+        content[field] = [
+            {'label': spec.get('label'), 'value': spec.get('value')} for spec in attributes.get(field) or []
+        ]
+    for relation in RELATION_ENDPOINTS:
+        content[relation] = relation_id(attributes.get(relation))
+    return hashlib.sha256(json.dumps(content, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+async def update_product_in_strapi(session, record, product_data, index=None, limiter=None):
+    """Overwrite an existing product with the row, or skip it without a request if nothing changed."""
+    data = {"data": build_product_payload(product_data)}
+    # A PUT only changes the fields it sends, so empty relations are sent as null to disconnect them
+    for relation in RELATION_ENDPOINTS:
+        data["data"].setdefault(relation, None)
+    if content_hash(data["data"]) == record['hash']:
+        return {'success': True, 'id': record['id'], 'action': 'unchanged'}
+
     try:
         headers = {
             'Authorization': f'Bearer {STRAPI_API_TOKEN}',
             'Content-Type': 'application/json'
         }
+        with metrics.timer('strapi_put'):
+            status, response_text = await strapi_request(
+                session, 'PUT', f"{STRAPI_API_URL}/api/catalog-products/{record['id']}",
+                limiter=limiter,
+                json=data,
+                headers=headers
+            )
+        logger.debug("Response from Strapi: %s", response_text)
+        if status != 200:
+            return {'success': False, 'reason': 'api_error', 'error': f'HTTP {status}'}
+        updated = json.loads(response_text).get('data') or {}
+        if index is not None:
+            index.add(
+                record['id'],
+                product_data.article,
+                product_data.slug,
+                updated.get('attributes', {}).get('updatedAt')
+            )
+        return {'success': True, 'id': record['id'], 'action': 'updated'}
+    except Exception as e:
+        logger.error("Error updating product: %s", e)
+        return {'success': False, 'reason': 'exception', 'error': str(e)}
 
-        # URL encode the article number for the query
-        encoded_article = product_data["article"].replace(' ', '%20')
-        
-        # Check if product with this article number already exists
-        async with session.get(
-            f'{STRAPI_API_URL}/api/catalog-products?filters[articleNumber][$eq]={encoded_article}',
-            headers=headers
-        ) as response:
-            if response.status == 200:
-                existing_products = await response.json()
+async def create_product_in_strapi(session, product_data, image_ids, existing_articles=None, index=None, limiter=None):
+    def release_article():
+        if index is not None:
+            index.release(product_data.article)
+        elif existing_articles is not None:
+            existing_articles.discard(product_data.article)
+
+    try:
+        headers = {
+            'Authorization': f'Bearer {STRAPI_API_TOKEN}',
+            'Content-Type': 'application/json'
+        }
+
+        if index is not None:
+            # Duplicates are checked against the local index instead of asking Strapi for every row
+            if not index.reserve(product_data.article):
+                return {'success': False, 'reason': 'duplicate'}
+        elif existing_articles is not None:
+            # Articles were resolved in bulk up front, so the check is a local lookup.
+            # The article is reserved right away so a repeated row in the same file
+            # can't be created twice by concurrent workers.
+            if product_data.article in existing_articles:
+                return {'success': False, 'reason': 'duplicate'}
+            existing_articles.add(product_data.article)
+        else:
+            # URL encode the article number for the query
+            encoded_article = product_data.article.replace(' ', '%20')
+
+            # Check if product with this article number already exists
+            with metrics.timer('duplicate_check'):
+                status, text = await strapi_request(
+                    session, 'GET',
+                    f'{STRAPI_API_URL}/api/catalog-products?filters[articleNumber][$eq]={encoded_article}',
+                    limiter=limiter,
+                    headers=headers
+                )
+            if status == 200:
+                existing_products = json.loads(text)
                 if existing_products.get('data') and len(existing_products['data']) > 0:
                     return {'success': False, 'reason': 'duplicate'}
             else:
-                print(f"Error checking for duplicates: {await response.text()}")
-
-        # Use the slug from product_data instead of generating it
-        data = {
-            "data": {
-                "name": product_data['name'],
-                "slug": product_data['slug'],  # Use the slug from product_data
-                "articleNumber": product_data['article'],
-                "description": product_data['description'],
-                "specifications": product_data.get('specifications', []),
-                "detailedSpecifications": product_data.get('detailedSpecifications', []),
-                "whereToBuyLink": product_data.get('whereToBuyLink', ""),
-                "publishedAt": None
-            }
-        }
+                logger.warning("Error checking for duplicates: %s", text)
 
-        # Add relations with proper format for Strapi v4 manyToOne relations
-        if product_data.get('category'):
-            data["data"]["category"] = {"id": product_data['category']}
-        if product_data.get('subcategory'):
-            data["data"]["subcategory"] = {"id": product_data['subcategory']}
-        if product_data.get('brand'):
-            data["data"]["brand"] = {"id": product_data['brand']}
-        if product_data.get('model'):
-            data["data"]["model"] = {"id": product_data['model']}
-        if product_data.get('modification'):
-            data["data"]["modification"] = {"id": product_data['modification']}
-
-        # Add image if provided and not None
-        if image_id:
-            data["data"]["images"] = [image_id]
-
-        print(f"Sending data to Strapi: {data}")
-
-        async with session.post(
-            f'{STRAPI_API_URL}/api/catalog-products',
-            json=data,
-            headers=headers
-        ) as response:
-            response_text = await response.text()
-            print(f"Response from Strapi: {response_text}")
-            if response.status not in [200, 201]:
-                return {'success': False, 'reason': 'api_error'}
-            return {'success': True}
+        data = {"data": build_product_payload(product_data)}
+        data["data"]["publishedAt"] = None
+
+        # Add images if provided and not None
+        if image_ids:
+            data["data"]["images"] = image_ids
+
+        logger.debug("Sending data to Strapi: %s", data)
+
+        with metrics.timer('strapi_post'):
+            status, response_text = await strapi_request(
+                session, 'POST', f'{STRAPI_API_URL}/api/catalog-products',
+                limiter=limiter,
+                json=data,
+                headers=headers
+            )
+        logger.debug("Response from Strapi: %s", response_text)
+        if status not in [200, 201]:
+            release_article()
+            if image_ids and 'images' in strapi_error_fields(response_text):
+                return {'success': False, 'reason': 'image_error', 'error': f'Strapi отклонил изображения: HTTP {status}'}
+            return {'success': False, 'reason': 'api_error', 'error': f'HTTP {status}'}
+        created = json.loads(response_text).get('data') or {}
+        if index is not None:
+            index.add(
+                created.get('id'),
+                product_data.article,
+                product_data.slug,
+                created.get('attributes', {}).get('updatedAt')
+            )
+        return {'success': True, 'id': created.get('id')}
     except Exception as e:
-        print(f"Error creating product: {e}")
+        logger.error("Error creating product: %s", e)
+        release_article()
         return {'success': False, 'reason': 'exception', 'error': str(e)}
+    except BaseException:
+        # A cancelled job must not leave the article claimed for the bot's lifetime
+        release_article()
+        raise
+
+async def publish_products(session, product_ids, limiter=None, on_batch=None):
+    """Publish draft products by id, PUBLISH_BATCH_SIZE at a time. Returns the ids that couldn't be published.
+
+    Strapi v4 has no bulk publish endpoint, so a batch is that many concurrent PUTs of publishedAt,
+    throttled by the limiter. on_batch(published, failed) is awaited after every batch.
+    """
+    headers = {
+        'Authorization': f'Bearer {STRAPI_API_TOKEN}',
+        'Content-Type': 'application/json'
+    }
+    data = {"data": {"publishedAt": time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())}}
+
+    async def publish(product_id):
+        try:
+            status, response_text = await strapi_request(
+                session, 'PUT', f"{STRAPI_API_URL}/api/catalog-products/{product_id}",
+                limiter=limiter,
+                json=data,
+                headers=headers
+            )
+        except Exception as e:
+            logger.error("Error publishing product %s: %s", product_id, e)
+            return False
+        if status != 200:
+            logger.error("Error publishing product %s: HTTP %s %s", product_id, status, response_text)
+        return status == 200
+
+    failed_ids = []
+    for start in range(0, len(product_ids), PUBLISH_BATCH_SIZE):
+        batch = product_ids[start:start + PUBLISH_BATCH_SIZE]
+        with metrics.timer('publish_batch'):
+            published = await asyncio.gather(*(publish(product_id) for product_id in batch))
+        failed_ids.extend(product_id for product_id, ok in zip(batch, published) if not ok)
+        metrics.inc('products_published', sum(published))
+        if on_batch is not None:
+            await on_batch(sum(published), len(batch) - sum(published))
+    return failed_ids
+
+class ImageUploader:
+    """Download product images and add them to the Strapi media library, with a concurrency limit of its own.
+
+    Media IDs are remembered by URL and by content hash, so an image used by many products is
+    downloaded once per URL and uploaded once per content, also across jobs. Both caches keep
+    the IMAGE_CACHE_SIZE most recently used entries for IMAGE_CACHE_TTL seconds, so an image
+    changed behind its URL is picked up again.
+    """
+
+    def __init__(self, concurrency):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        # url -> (task returning the media ID, time stored), content hash -> the same; least recently used first
+        self.by_url = OrderedDict()
+        self.by_hash = OrderedDict()
+
+    @staticmethod
+    def _cached(cache, key):
+        entry = cache.get(key)
+        if entry is None:
+            return None
+        task, stored_at = entry
+        if time.monotonic() - stored_at > IMAGE_CACHE_TTL:
+            del cache[key]
+            return None
+        cache.move_to_end(key)
+        return task
+
+    @staticmethod
+    def _store(cache, key, task):
+        cache[key] = (task, time.monotonic())
+        while len(cache) > IMAGE_CACHE_SIZE:
+            cache.popitem(last=False)
+        return task
+
+    @staticmethod
+    def _evict(cache, key, task):
+        # Only if the entry wasn't replaced in the meantime
+        if cache.get(key, (None,))[0] is task:
+            del cache[key]
+
+    def forget(self, media_ids):
+        """Drop cached media IDs that Strapi rejected, e.g. because the media was deleted."""
+        for cache in (self.by_url, self.by_hash):
+            for key, (task, _) in list(cache.items()):
+                if task.done() and not task.cancelled() and task.exception() is None and task.result() in media_ids:
+                    del cache[key]
+
+    async def get_ids(self, session, urls):
+        """Return the media IDs for the image URLs of a row."""
+        tasks = []
+        for url in urls:
+            task = self._cached(self.by_url, url)
+            if task is None:
+                task = self._store(self.by_url, url, asyncio.ensure_future(self._upload_url(session, url)))
+            else:
+                metrics.inc('images_reused')
+            tasks.append(task)
+        # Shielded since other rows may be waiting for the same image
+        return list(await asyncio.gather(*(asyncio.shield(task) for task in tasks)))
+
+    async def _upload_url(self, session, url):
+        try:
+            async with self.semaphore:
+                with metrics.timer('image_download'):
+                    data, content_type = await self._download(session, url)
+            file_hash = hashlib.sha256(data).hexdigest()
+            task = self._cached(self.by_hash, file_hash)
+            if task is None:
+                file_name = os.path.basename(urlparse(url).path) or file_hash
+                task = self._store(self.by_hash, file_hash, asyncio.ensure_future(
+                    self._upload(session, data, content_type, file_name, file_hash)
+                ))
+            else:
+                metrics.inc('images_reused')
+            return await asyncio.shield(task)
+        except BaseException:
+            # Let a later row try again
+            self._evict(self.by_url, url, asyncio.current_task())
+            raise
+
+    async def _download(self, session, url):
+        async with session.get(url) as response:
+            if response.status != 200:
+                raise RuntimeError(f"Изображение {url}: HTTP {response.status}")
+            if not response.content_type.startswith('image/'):
+                raise RuntimeError(f"{url} не является изображением ({response.content_type})")
+            if response.content_length and response.content_length > IMAGE_MAX_SIZE:
+                raise RuntimeError(f"Изображение {url} больше {IMAGE_MAX_SIZE // (1024 * 1024)} МБ")
+            data = bytearray()
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                data += chunk
+                if len(data) > IMAGE_MAX_SIZE:
+                    raise RuntimeError(f"Изображение {url} больше {IMAGE_MAX_SIZE // (1024 * 1024)} МБ")
+            return bytes(data), response.content_type
+
+    async def _upload(self, session, data, content_type, file_name, file_hash):
+        try:
+            # Unlike FormData, a MultipartWriter can be sent again when the request is retried
+            form = aiohttp.MultipartWriter('form-data')
+            part = form.append(data, {'Content-Type': content_type})
+            part.set_content_disposition('form-data', name='files', filename=file_name)
+            async with self.semaphore:
+                with metrics.timer('image_upload'):
+                    status, text = await strapi_request(
+                        session, 'POST', f'{STRAPI_API_URL}/api/upload',
+                        data=form,
+                        headers={'Authorization': f'Bearer {STRAPI_API_TOKEN}'}
+                    )
+            if status not in [200, 201]:
+                raise RuntimeError(f"Загрузка изображения {file_name}: HTTP {status}")
+            metrics.inc('images_uploaded')
+            return json.loads(text)[0]['id']
+        except BaseException:
+            self._evict(self.by_hash, file_hash, asyncio.current_task())
+            raise
+
+TEMPLATE_HEADERS = [
+    "Название", 
+    "Slug (URL)", 
+    "Артикул", 
+    "Описание", 
+    "ID категории", 
+    "ID подкатегории", 
+    "ID бренда", 
+    "ID модели", 
+    "ID модификации", 
+    "Спецификации (краткие)", 
+    "Спецификации (подробные)", 
+    "Ссылка где купить",
+    "Изображения (URL)"
+]
+TEMPLATE_COLUMNS = len(TEMPLATE_HEADERS)
+
+TEMPLATE_EXAMPLE = [
+    "Тормозной диск передний",  # Название (на русском)
+    "brake-disc-front",         # Slug (на английском)
+    "BD-12345",                 # Артикул
+    "Высококачественный тормозной диск для передней оси",  # Описание
+    "1",                        # ID категории
+    "2",                        # ID подкатегории
+    "3",                        # ID бренда
+    "4",                        # ID модели
+    "5",                        # ID модификации
+    "Диаметр:280мм, Толщина:22мм",  # Спецификации (краткие)
+    "Диаметр:280мм, Толщина:22мм, Тип:Вентилируемый, Покрытие:С покрытием",  # Спецификации (подробные)
+    "https://example.com/product",  # Ссылка где купить
+    "https://example.com/images/brake-disc.jpg"  # Изображения (необязательно, можно несколько через пробел)
+]
+
+# Template built once in memory, and the Telegram file_id it got when it was first sent
+_template_cache = {'layout': None, 'bytes': None, 'file_id': None}
+
+def build_template():
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+
+    # Add headers
+    for col, header in enumerate(TEMPLATE_HEADERS, 1):
+        sheet.cell(row=1, column=col, value=header)
+
+    # Add example row
+    for col, value in enumerate(TEMPLATE_EXAMPLE, 1):
+        sheet.cell(row=2, column=col, value=value)
+
+    # Adjust column widths
+    for col in range(1, len(TEMPLATE_HEADERS) + 1):
+        sheet.column_dimensions[openpyxl.utils.get_column_letter(col)].width = 25
+
+    template = io.BytesIO()
+    workbook.save(template)
+    return template.getvalue()
+
+def get_template_bytes():
+    """Return the template workbook, rebuilding it only when the column layout has changed."""
+    layout = (tuple(TEMPLATE_HEADERS), tuple(TEMPLATE_EXAMPLE))
+    if _template_cache['layout'] != layout:
+        _template_cache['bytes'] = build_template()
+        _template_cache['layout'] = layout
+        # The file uploaded before has the old layout
+        _template_cache['file_id'] = None
+    return _template_cache['bytes']
 
 async def create_and_send_template(message):
     try:
-        workbook = openpyxl.Workbook()
-        sheet = workbook.active
-        
-        headers = [
-            "Название", 
-            "Slug (URL)", 
-            "Артикул", 
-            "Описание", 
-            "ID категории", 
-            "ID подкатегории", 
-            "ID бренда", 
-            "ID модели", 
-            "ID модификации", 
-            "Спецификации (краткие)", 
-            "Спецификации (подробные)", 
-            "Ссылка где купить"
-        ]
-        
-        # Add headers
-        for col, header in enumerate(headers, 1):
-            sheet.cell(row=1, column=col, value=header)
-        
-        # Add example row
-        example_data = [
-            "Тормозной диск передний",  # Название (на русском)
-            "brake-disc-front",         # Slug (на английском)
-            "BD-12345",                 # Артикул
-            "Высококачественный тормозной диск для передней оси",  # Описание
-            "1",                        # ID категории
-            "2",                        # ID подкатегории
-            "3",                        # ID бренда
-            "4",                        # ID модели
-            "5",                        # ID модификации
-            "Диаметр:280мм, Толщина:22мм",  # Спецификации (краткие)
-            "Диаметр:280мм, Толщина:22мм, Тип:Вентилируемый, Покрытие:С покрытием",  # Спецификации (подробные)
-            "https://example.com/product"  # Ссылка где купить
-        ]
-        
-        for col, value in enumerate(example_data, 1):
-            sheet.cell(row=2, column=col, value=value)
-        
-        # Adjust column widths
-        for col in range(1, len(headers) + 1):
-            sheet.column_dimensions[openpyxl.utils.get_column_letter(col)].width = 25
-        
-        # Save template
-        temp_file = 'template.xlsx'
-        workbook.save(temp_file)
-        
-        # Send template
-        await message.reply_document(
-            document=open(temp_file, 'rb'),
-            filename='template.xlsx',
-            caption="✅ Шаблон для загрузки товаров"
-        )
-        
-        os.remove(temp_file)
+        template_bytes = get_template_bytes()
+
+        # Send template: reuse the already uploaded file when possible
+        sent = None
+        if _template_cache['file_id']:
+            try:
+                sent = await message.reply_document(
+                    document=_template_cache['file_id'],
+                    caption="✅ Шаблон для загрузки товаров"
+                )
+            except TelegramError as e:
+                logger.warning("Error resending cached template: %s", e)
+                _template_cache['file_id'] = None
+        if sent is None:
+            sent = await message.reply_document(
+                document=io.BytesIO(template_bytes),
+                filename='template.xlsx',
+                caption="✅ Шаблон для загрузки товаров"
+            )
+            _template_cache['file_id'] = sent.document.file_id
         
         await message.reply_text(
             "Используйте этот шаблон для подготовки данных.\n"
@@ -244,154 +2166,516 @@ async def create_and_send_template(message):
         )
         
     except Exception as e:
-        print(f"Error creating template: {e}")
+        logger.error("Error creating template: %s", e)
         await message.reply_text(
             "❌ Произошла ошибка при создании шаблона.\n"
             "Попробуйте еще раз используя /start"
         )
 
+RUSSIAN_TO_LATIN = str.maketrans({
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'yo',
+    'ж': 'zh', 'з': 'z', 'и': 'i', 'й': 'y', 'к': 'k', 'л': 'l', 'м': 'm',
+    'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r', 'с': 's', 'т': 't', 'у': 'u',
+    'ф': 'f', 'х': 'h', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'sch', 'ъ': '',
+    'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'yu', 'я': 'ya',
+    'А': 'A', 'Б': 'B', 'В': 'V', 'Г': 'G', 'Д': 'D', 'Е': 'E', 'Ё': 'Yo',
+    'Ж': 'Zh', 'З': 'Z', 'И': 'I', 'Й': 'Y', 'К': 'K', 'Л': 'L', 'М': 'M',
+    'Н': 'N', 'О': 'O', 'П': 'P', 'Р': 'R', 'С': 'S', 'Т': 'T', 'У': 'U',
+    'Ф': 'F', 'Х': 'H', 'Ц': 'Ts', 'Ч': 'Ch', 'Ш': 'Sh', 'Щ': 'Sch', 'Ъ': '',
+    'Ы': 'Y', 'Ь': '', 'Э': 'E', 'Ю': 'Yu', 'Я': 'Ya'
+})
+# Anything Strapi doesn't accept in a UID, and runs of separators
+SLUG_INVALID_CHARS = re.compile(r'[^a-z0-9_\s-]')
+SLUG_SEPARATORS = re.compile(r'[-\s]+')
+
 def transliterate_russian(text):
     """Transliterate Russian text to Latin characters."""
-    russian_to_latin = {
-        'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'yo',
-        'ж': 'zh', 'з': 'z', 'и': 'i', 'й': 'y', 'к': 'k', 'л': 'l', 'м': 'm',
-        'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r', 'с': 's', 'т': 't', 'у': 'u',
-        'ф': 'f', 'х': 'h', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'sch', 'ъ': '',
-        'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'yu', 'я': 'ya',
-        'А': 'A', 'Б': 'B', 'В': 'V', 'Г': 'G', 'Д': 'D', 'Е': 'E', 'Ё': 'Yo',
-        'Ж': 'Zh', 'З': 'Z', 'И': 'I', 'Й': 'Y', 'К': 'K', 'Л': 'L', 'М': 'M',
-        'Н': 'N', 'О': 'O', 'П': 'P', 'Р': 'R', 'С': 'S', 'Т': 'T', 'У': 'U',
-        'Ф': 'F', 'Х': 'H', 'Ц': 'Ts', 'Ч': 'Ch', 'Ш': 'Sh', 'Щ': 'Sch', 'Ъ': '',
-        'Ы': 'Y', 'Ь': '', 'Э': 'E', 'Ю': 'Yu', 'Я': 'Ya'
-    }
-    
-    result = ''
-    for char in text:
-        result += russian_to_latin.get(char, char)
-    return result
+    return text.translate(RUSSIAN_TO_LATIN)
 
 def create_slug(text):
     """Create a URL-friendly slug from text."""
-    # First transliterate Russian characters
-    text = transliterate_russian(text)
-    # Convert to lowercase
-    text = text.lower()
+    # First transliterate Russian characters, then convert to lowercase
+    text = transliterate_russian(text).lower()
     # Replace spaces and special characters with hyphens
-    text = re.sub(r'[^\w\s-]', '', text)
-    text = re.sub(r'[-\s]+', '-', text)
+    text = SLUG_INVALID_CHARS.sub('', text)
+    text = SLUG_SEPARATORS.sub('-', text)
     # Remove leading/trailing hyphens
-    text = text.strip('-')
-    return text
+    return text.strip('-')
+
+class SlugResolver:
+    """Make the slugs of one file unique, within the file and against the products already in Strapi.
+
+    Batches must be passed in row order. The first row keeps its slug and later generated slugs
+    get -2, -3, ... suffixes, so the same file against the same catalog always gets the same slugs.
+    A taken slug that was filled in by hand is reported as an error instead of being changed.
+    """
 
-def extract_data_from_excel(excel_bytes):
-    temp_file = 'temp_excel.xlsx'
-    with open(temp_file, 'wb') as f:
-        f.write(excel_bytes)
+    def __init__(self, session, index=None):
+        self.session = session
+        self.index = index
+        # slug -> article of the row in this file that uses it
+        self.claimed = {}
+        # slug -> article of the product in Strapi, or None if it's free
+        self.owners = {}
+        # base slug -> next suffix to try
+        self.next_suffix = {}
 
+    async def _fetch_owners(self, slugs):
+        slugs = [slug for slug in slugs if slug not in self.owners]
+        if not slugs:
+            return
+        if self.index is not None:
+            owners = self.index.slug_owners(slugs)
+        else:
+            with metrics.timer('slug_check'):
+                items = await _fetch_products_by(
+                    self.session, 'slug', slugs, [('fields[0]', 'articleNumber'), ('fields[1]', 'slug')]
+                )
+            # If the check failed the slugs are taken as free and Strapi itself rejects a taken one
+            owners = {slug: item['attributes']['articleNumber'] for slug, item in (items or {}).items()}
+        for slug in slugs:
+            self.owners[slug] = owners.get(slug)
+
+    async def resolve(self, products):
+        """Assign unique slugs to the valid products of a batch, adding errors for taken custom slugs."""
+        products = [product for product in products if not product.errors]
+        await self._fetch_owners({product.slug for product in products})
+        for product in products:
+            base = product.slug
+            slug = base
+            while True:
+                if slug not in self.owners:
+                    # Look a few suffixes ahead so a run of taken ones costs a single query
+                    suffix = self.next_suffix.get(base, 2)
+                    await self._fetch_owners([slug] + [f"{base}-{n}" for n in range(suffix, suffix + 10)])
+                owner = self.claimed.get(slug, self.owners[slug])
+                if owner is None or owner == product.article:
+                    self.claimed[slug] = product.article
+                    product.slug = slug
+                    break
+                if not product.slug_generated:
+                    product.errors = [f"B{product.row}: Slug «{slug}» уже используется другим товаром"]
+                    break
+                suffix = self.next_suffix.get(base, 2)
+                self.next_suffix[base] = suffix + 1
+                slug = f"{base}-{suffix}"
+
+# Sheet column and title of each template field, for error messages
+FIELD_COLUMNS = {
+    'name': ('A', 'Название'),
+    'slug': ('B', 'Slug'),
+    'article': ('C', 'Артикул'),
+    'description': ('D', 'Описание'),
+    'category': ('E', 'ID категории'),
+    'subcategory': ('F', 'ID подкатегории'),
+    'brand': ('G', 'ID бренда'),
+    'model': ('H', 'ID модели'),
+    'modification': ('I', 'ID модификации'),
+    'where_to_buy_link': ('L', 'Ссылка где купить'),
+    'image_urls': ('M', 'Изображения')
+}
+REQUIRED_FIELDS = ('name', 'article', 'category', 'where_to_buy_link')
+# Characters Strapi accepts in a UID field
+SLUG_PATTERN = re.compile(r'^[A-Za-z0-9\-_.~]+$')
+# Several image URLs in one cell are separated by whitespace, commas or semicolons
+IMAGE_URL_SEPARATORS = re.compile(r'[\s,;]+')
+
+def parse_image_urls(value, row_idx, errors):
+    urls = tuple(url for url in IMAGE_URL_SEPARATORS.split(str(value or '')) if url)
+    for url in urls:
+        parsed = urlparse(url)
+        if parsed.scheme not in ('http', 'https') or not parsed.netloc:
+            column, title = FIELD_COLUMNS['image_urls']
+            errors.append(f"{column}{row_idx}: {title}: «{url}» не является ссылкой")
+    return urls
+
+def parse_relation_id(value, field, row_idx, errors):
     try:
-        workbook = openpyxl.load_workbook(temp_file)
-        sheet = workbook.active
+        return int(value or 0)
+    except (TypeError, ValueError):
+        column, title = FIELD_COLUMNS[field]
+        errors.append(f"{column}{row_idx}: {title} «{value}» не является числом")
+        return 0
 
-        products_data = []
-        for row_idx in range(2, sheet.max_row + 1):
-            if not sheet.cell(row=row_idx, column=1).value:
-                continue
+# Used for empty specification columns, Strapi requires at least one entry
+DEFAULT_SPECIFICATIONS = (('General', 'Not specified'),)
 
-            # Process specifications (column J)
-            spec_value = str(sheet.cell(row=row_idx, column=10).value or '')
-            specs = []
-            if spec_value:
-                spec_parts = spec_value.split(',')
-                for i, part in enumerate(spec_parts):
-                    if ':' in part:
-                        name, value = part.split(':', 1)
-                        specs.append({
-                            "label": name.strip(),
-                            "value": value.strip()
-                        })
-                    else:
-                        specs.append({
-                            "label": f"Specification {i+1}",
-                            "value": part.strip()
-                        })
-
-            # Process detailed specifications (column K)
-            detailed_spec_value = str(sheet.cell(row=row_idx, column=11).value or '')
-            detailed_specs = []
-            if detailed_spec_value:
-                detailed_spec_parts = detailed_spec_value.split(',')
-                for i, part in enumerate(detailed_spec_parts):
-                    if ':' in part:
-                        name, value = part.split(':', 1)
-                        detailed_specs.append({
-                            "label": name.strip(),
-                            "value": value.strip()
-                        })
-                    else:
-                        detailed_specs.append({
-                            "label": f"Specification {i+1}",
-                            "value": part.strip()
-                        })
-
-            # Ensure at least one specification exists for both
-            if not specs:
-                specs = [{
-                    "label": "General",
-                    "value": "Not specified"
-                }]
-            if not detailed_specs:
-                detailed_specs = [{
-                    "label": "General",
-                    "value": "Not specified"
-                }]
-
-            name = str(sheet.cell(row=row_idx, column=1).value or '').strip()
-            custom_slug = str(sheet.cell(row=row_idx, column=2).value or '').strip()
-            
-            # If no custom slug is provided, create one from the name
-            if not custom_slug:
-                custom_slug = create_slug(name)
-            
-            product = {
-                'name': name,
-                'slug': custom_slug,
-                'article': str(sheet.cell(row=row_idx, column=3).value or '').strip(),
-                'description': str(sheet.cell(row=row_idx, column=4).value or '').strip(),
-                'category': int(sheet.cell(row=row_idx, column=5).value or 0),
-                'subcategory': int(sheet.cell(row=row_idx, column=6).value or 0),
-                'brand': int(sheet.cell(row=row_idx, column=7).value or 0),
-                'model': int(sheet.cell(row=row_idx, column=8).value or 0),
-                'modification': int(sheet.cell(row=row_idx, column=9).value or 0),
-                'specifications': specs,
-                'detailedSpecifications': detailed_specs,
-                'whereToBuyLink': str(sheet.cell(row=row_idx, column=12).value or '').strip()
-            }
-            
-            if product['name'] and product['article'] and product['category'] and product['whereToBuyLink']:
-                products_data.append(product)
+@lru_cache(maxsize=SPEC_CACHE_SIZE)
+def parse_specifications(value):
+    """Parse "label:value, ..." into a tuple of (label, value) pairs.
+
+    Catalogs repeat the same specification strings across many rows, so results are cached
+    and labels interned; rows with equal strings share one tuple.
+    """
+    specs = []
+    if value:
+        for i, part in enumerate(value.split(',')):
+            if ':' in part:
+                name, part_value = part.split(':', 1)
+                specs.append((sys.intern(name.strip()), part_value.strip()))
             else:
-                print(f"Skipping row {row_idx} due to missing required fields")
+                specs.append((f"Specification {i+1}", part.strip()))
+    return tuple(specs) or DEFAULT_SPECIFICATIONS
 
-        print(f"Successfully processed {len(products_data)} products from Excel")
-        return products_data
+def format_specifications(specs):
+    """Write [{"label": ..., "value": ...}] back as the "label:value, ..." string parse_specifications reads."""
+    return ', '.join(f"{spec.get('label', '')}:{spec.get('value', '')}" for spec in specs or [])
+
+@dataclass(slots=True)
+class ProductRecord:
+    """One parsed row, kept compact until build_product_payload turns it into JSON for Strapi.
+
+    Problems with the row are listed in errors; such rows must not be uploaded.
+    cells holds the original values for annotated reports when they were asked for.
+    """
+    row: int
+    name: str
+    slug: str
+    article: str
+    description: str
+    category: int
+    subcategory: int
+    brand: int
+    model: int
+    modification: int
+    specifications: tuple
+    detailed_specifications: tuple
+    where_to_buy_link: str
+    image_urls: tuple = ()
+    # False when the slug was filled in by hand
+    slug_generated: bool = False
+    # Row of the same file that already has this article; such rows are skipped
+    duplicate_of: int = None
+    errors: list = None
+    cells: list = None
+
+def build_product(row, row_idx, keep_cells=False):
+    """Turn the cell values of a row (template column order) into a ProductRecord."""
+    errors = []
+    name = str(row[0] or '').strip()
+    custom_slug = str(row[1] or '').strip()
+
+    if custom_slug and not SLUG_PATTERN.match(custom_slug):
+        errors.append(f"B{row_idx}: Slug «{custom_slug}» может содержать только латинские буквы, цифры и дефисы")
+    # If no custom slug is provided, create one from the name
+    slug_generated = not custom_slug
+    if slug_generated:
+        custom_slug = create_slug(name)
+        if name and not custom_slug:
+            errors.append(f"B{row_idx}: не удалось создать Slug из названия, заполните его вручную")
+
+    product = ProductRecord(
+        row=row_idx,
+        name=name,
+        slug=custom_slug,
+        article=str(row[2] or '').strip(),
+        description=str(row[3] or '').strip(),
+        category=parse_relation_id(row[4], 'category', row_idx, errors),
+        subcategory=parse_relation_id(row[5], 'subcategory', row_idx, errors),
+        brand=parse_relation_id(row[6], 'brand', row_idx, errors),
+        model=parse_relation_id(row[7], 'model', row_idx, errors),
+        modification=parse_relation_id(row[8], 'modification', row_idx, errors),
+        # Columns J and K
+        specifications=parse_specifications(str(row[9] or '')),
+        detailed_specifications=parse_specifications(str(row[10] or '')),
+        where_to_buy_link=str(row[11] or '').strip(),
+        image_urls=parse_image_urls(row[12], row_idx, errors),
+        slug_generated=slug_generated
+    )
+
+    for field in REQUIRED_FIELDS:
+        if not getattr(product, field) and not any(error.startswith(f"{FIELD_COLUMNS[field][0]}{row_idx}:") for error in errors):
+            column, title = FIELD_COLUMNS[field]
+            errors.append(f"{column}{row_idx}: {title} не заполнено")
+
+    if errors:
+        logger.debug("Invalid row %d: %s", row_idx, '; '.join(errors))
+        product.errors = errors
+    if keep_cells:
+        product.cells = [None if value is None else str(value) for value in row[:TEMPLATE_COLUMNS]]
+    return product
+
+def open_source(source):
+    """Open an uploaded file given as a path or as bytes for binary reading."""
+    if isinstance(source, (bytes, bytearray)):
+        return io.BytesIO(source)
+    return open(source, 'rb')
+
+def count_lines(source):
+    """Count the lines of a file without holding all of it in memory."""
+    lines = 0
+    last = b'\n'
+    with open_source(source) as stream:
+        while block := stream.read(1024 * 1024):
+            lines += block.count(b'\n')
+            last = block[-1:]
+    # A last line without a line break counts too
+    return lines + (last != b'\n')
+
+def extract_data_from_excel(source, stats=None, keep_cells=False):
+    """Yield products from the active sheet one row at a time, without loading the whole workbook.
+
+    If a stats dict is passed, the number of data rows reported by the sheet is stored in it
+    under 'total_rows' before the first product is yielded. A file that can't be read yields
+    nothing; an error after the first product is raised.
+    """
+    try:
+        # A file object, since openpyxl rejects paths without an Excel extension such as spool files
+        stream = open_source(source)
+    except OSError as e:
+        logger.error("Error processing Excel file: %s", e)
+        return
+    try:
+        workbook = openpyxl.load_workbook(stream, read_only=True)
+    except Exception as e:
+        logger.error("Error processing Excel file: %s", e)
+        stream.close()
+        return
+
+    rows_count = 0
+    try:
+        sheet = workbook.active
+        if stats is not None and sheet.max_row:
+            stats['total_rows'] = sheet.max_row - 1
+        for row_idx, row in enumerate(sheet.iter_rows(min_row=2, max_col=TEMPLATE_COLUMNS, values_only=True), 2):
+            # Trailing empty cells are not returned in read-only mode
+            row = tuple(row) + (None,) * (TEMPLATE_COLUMNS - len(row))
+            if not row[0]:
+                continue
+            rows_count += 1
+            yield build_product(row, row_idx, keep_cells)
+
+        logger.info("Processed %d rows from Excel", rows_count)
 
     except Exception as e:
-        print(f"Error processing Excel file: {e}")
-        return []
+        logger.error("Error processing Excel file: %s", e)
+        if rows_count:
+            # Rows were already handed out: the import must not look complete
+            raise
     finally:
-        if os.path.exists(temp_file):
-            os.remove(temp_file)
+        workbook.close()
+        stream.close()
+
+def extract_data_from_csv(source, delimiter=',', stats=None, keep_cells=False):
+    """Yield products from a CSV/TSV file with a header row and the template's column order."""
+    rows_count = 0
+    try:
+        if stats is not None:
+            # Counting lines is much cheaper than parsing; quoted multi-line cells make it an estimate
+            stats['total_rows'] = max(count_lines(source) - 1, 0)
+        # utf-8-sig also accepts the BOM that Excel puts in front of exported CSV files
+        with io.TextIOWrapper(open_source(source), encoding='utf-8-sig', newline='') as stream:
+            reader = csv.reader(stream, delimiter=delimiter)
+            next(reader, None)
+            for row in reader:
+                row_idx = reader.line_num
+                row = (row + [None] * TEMPLATE_COLUMNS)[:TEMPLATE_COLUMNS]
+                if not row[0]:
+                    continue
+                rows_count += 1
+                yield build_product(row, row_idx, keep_cells)
+
+        logger.info("Processed %d rows from CSV", rows_count)
+
+    except Exception as e:
+        logger.error("Error processing CSV file: %s", e)
+        if rows_count:
+            raise
+
+# JSONL keys for each template column; the Russian template headers are accepted as well
+JSONL_FIELDS = [
+    'name', 'slug', 'article', 'description', 'category', 'subcategory', 'brand', 'model',
+    'modification', 'specifications', 'detailedSpecifications', 'whereToBuyLink', 'images'
+]
+
+def extract_data_from_jsonl(source, stats=None, keep_cells=False):
+    """Yield products from a JSON Lines file with one product object per line."""
+    rows_count = 0
+    try:
+        if stats is not None:
+            stats['total_rows'] = count_lines(source)
+        with open_source(source) as stream:
+            for row_idx, line in enumerate(stream, 1):
+                if not line.strip():
+                    continue
+                try:
+                    item = json.loads(line)
+                except ValueError as e:
+                    logger.debug("Skipping line %d: %s", row_idx, e)
+                    continue
+                if not isinstance(item, dict):
+                    logger.debug("Skipping line %d: not a JSON object", row_idx)
+                    continue
+                row = []
+                for field, header in zip(JSONL_FIELDS, TEMPLATE_HEADERS):
+                    value = item.get(field, item.get(header.strip()))
+                    if isinstance(value, list) and field == 'images':
+                        value = ' '.join(value)
+                    elif isinstance(value, list):
+                        # Specifications can also be given as [{"label": ..., "value": ...}]
+                        value = format_specifications(value)
+                    row.append(value)
+                if not row[0]:
+                    continue
+                rows_count += 1
+                yield build_product(row, row_idx, keep_cells)
+
+        logger.info("Processed %d rows from JSONL", rows_count)
+
+    except Exception as e:
+        logger.error("Error processing JSONL file: %s", e)
+        if rows_count:
+            raise
+
+# Supported upload formats by file extension and MIME type
+FILE_FORMATS_BY_EXTENSION = {
+    '.xlsx': 'xlsx',
+    '.xlsm': 'xlsx',
+    '.csv': 'csv',
+    '.tsv': 'tsv',
+    '.tab': 'tsv',
+    '.jsonl': 'jsonl',
+    '.ndjson': 'jsonl'
+}
+FILE_FORMATS_BY_MIME_TYPE = {
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet': 'xlsx',
+    'text/csv': 'csv',
+    'text/tab-separated-values': 'tsv',
+    'application/jsonl': 'jsonl',
+    'application/x-ndjson': 'jsonl'
+}
+
+def detect_file_format(file_name, mime_type=None):
+    """Guess the upload format from the file extension, then the MIME type. Defaults to xlsx."""
+    extension = os.path.splitext(file_name or '')[1].lower()
+    if extension in FILE_FORMATS_BY_EXTENSION:
+        return FILE_FORMATS_BY_EXTENSION[extension]
+    return FILE_FORMATS_BY_MIME_TYPE.get(mime_type, 'xlsx')
+
+def extract_products(source, file_format, stats=None, keep_cells=False):
+    """Yield products from an uploaded file in any supported format, given as a path or as bytes."""
+    if file_format == 'csv':
+        products = extract_data_from_csv(source, ',', stats, keep_cells)
+    elif file_format == 'tsv':
+        products = extract_data_from_csv(source, '\t', stats, keep_cells)
+    elif file_format == 'jsonl':
+        products = extract_data_from_jsonl(source, stats, keep_cells)
+    else:
+        products = extract_data_from_excel(source, stats, keep_cells)
+    return mark_repeated_rows(products)
+
+def mark_repeated_rows(products):
+    """Flag rows that repeat the article or the hand-filled slug of an earlier valid row of the file.
+
+    Done in the parsing pass, so which row wins doesn't depend on how concurrently the rows are
+    uploaded: the first one keeps the article and later ones never reach the network.
+    """
+    # article / hand-filled slug -> first row using it
+    article_rows = {}
+    slug_rows = {}
+    for product in products:
+        if not product.errors:
+            if product.article in article_rows:
+                product.duplicate_of = article_rows[product.article]
+            elif not product.slug_generated and product.slug in slug_rows:
+                product.errors = [f"B{product.row}: Slug «{product.slug}» уже есть в строке {slug_rows[product.slug]}"]
+            else:
+                article_rows[product.article] = product.row
+                if not product.slug_generated:
+                    slug_rows[product.slug] = product.row
+        yield product
+
+def create_strapi_session():
+    """Create the HTTP session whose connection pool is shared by all Strapi requests."""
+    connector = aiohttp.TCPConnector(
+        limit=STRAPI_CONNECTION_LIMIT,
+        limit_per_host=STRAPI_CONNECTION_LIMIT_PER_HOST,
+        keepalive_timeout=STRAPI_KEEPALIVE_TIMEOUT,
+        ttl_dns_cache=STRAPI_DNS_CACHE_TTL
+    )
+    timeout = aiohttp.ClientTimeout(
+        total=STRAPI_REQUEST_TIMEOUT,
+        connect=STRAPI_CONNECT_TIMEOUT
+    )
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+async def serve_metrics(request):
+    return web.Response(text=metrics.render_prometheus(), content_type='text/plain', charset='utf-8')
+
+async def start_metrics_server():
+    app = web.Application()
+    app.router.add_get('/metrics', serve_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, int(METRICS_PORT)).start()
+    logger.info("Serving metrics on http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+    return runner
+
+async def post_init(application: Application):
+    application.bot_data['http_session'] = create_strapi_session()
+    application.bot_data['job_scheduler'] = JobScheduler(MAX_CONCURRENT_JOBS)
+    application.bot_data['relation_cache'] = RelationCache(RELATION_CACHE_TTL)
+    get_template_bytes()
+    if METRICS_PORT:
+        application.bot_data['metrics_runner'] = await start_metrics_server()
+    # Shared by all jobs, since they all load the same Strapi
+    application.bot_data['strapi_limiter'] = AdaptiveLimiter(
+        UPLOAD_CONCURRENCY, UPLOAD_MIN_CONCURRENCY, UPLOAD_MAX_CONCURRENCY, UPLOAD_TARGET_LATENCY
+    )
+    application.bot_data['image_uploader'] = ImageUploader(IMAGE_CONCURRENCY)
+    application.bot_data['parse_pool'] = ProcessPoolExecutor(max_workers=PARSE_WORKERS)
+    # Queues between the parse workers and the bot have to be shared through a manager
+    application.bot_data['parse_manager'] = multiprocessing.Manager()
+
+async def post_shutdown(application: Application):
+    metrics_runner = application.bot_data.pop('metrics_runner', None)
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    session = application.bot_data.pop('http_session', None)
+    if session is not None:
+        await session.close()
+    pool = application.bot_data.pop('parse_pool', None)
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+    manager = application.bot_data.pop('parse_manager', None)
+    if manager is not None:
+        manager.shutdown()
 
 def main():
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("status", status))
+    application.add_handler(CommandHandler("cancel", cancel))
+    application.add_handler(CommandHandler("resume", resume))
+    application.add_handler(CommandHandler("stats", stats))
+    application.add_handler(CommandHandler("export", export))
     application.add_handler(CallbackQueryHandler(button))
     application.add_handler(MessageHandler(filters.Document.ALL, process_excel))
     application.add_handler(MessageHandler(filters.TEXT, handle_message))
 
-    print("Starting bot...")
-    application.run_polling()
+    # run_polling and run_webhook own the event loop: post_init, the handlers and post_shutdown all run on it
+    if BOT_MODE == 'webhook':
+        if not WEBHOOK_URL:
+            logger.error("WEBHOOK_URL must be set when BOT_MODE=webhook")
+            sys.exit(1)
+        logger.info("Starting bot with a webhook on %s:%d/%s...", WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH)
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET_TOKEN
+        )
+    else:
+        logger.info("Starting bot...")
+        application.run_polling()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
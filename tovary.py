@@ -6,9 +6,6 @@ import aiohttp
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
-import nest_asyncio
-
-nest_asyncio.apply()
 
 load_dotenv()
 